@@ -1,49 +1,116 @@
-import numpy as np
 import torch.nn as nn
 import torch
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
 from sklearn.cluster import KMeans
-from sklearn import metrics
-from torchmetrics.clustering import AdjustedRandScore, NormalizedMutualInfoScore
-from torchmetrics import F1Score
 from seed_manager import set_seed
-from util_scores import get_scores
+from util_scores import ClusteringScorer, LabelAligner, get_scores
 
 
-def purity_score(y_true, y_pred):
-    # compute contingency matrix (also called confusion matrix)
-    contingency_matrix = metrics.cluster.contingency_matrix(y_true, y_pred)
-    # return purity
-    return np.sum(np.amax(contingency_matrix, axis=0)) / np.sum(contingency_matrix)
+def top_left_singular_vectors(H, k, n_oversamples=8, n_iter=2, generator=None):
+    """
+    Top-k left singular vectors of H by a randomized SVD (Halko et al., 2011), the random directions are
+    drawn from generator. Every column is signed so its largest-magnitude entry is positive, the same
+    H and generator state always give the same vectors.
 
+    :param H: [b, d] matrix
+    :return: [b, k] singular vectors
+    """
+    q = k + n_oversamples
+    if q < min(H.shape):
+        omega = torch.randn(H.shape[1], q, generator=generator, device=H.device, dtype=H.dtype)
+        Q = torch.linalg.qr(H @ omega).Q
+        # subspace iterations, re-orthonormalized after every product
+        for _ in range(n_iter):
+            Q = torch.linalg.qr(H @ torch.linalg.qr(H.T @ Q).Q).Q
+        U = Q @ torch.linalg.svd(Q.T @ H, full_matrices=False).U
+    else:
+        U = torch.linalg.svd(H, full_matrices=False).U
+    U = U[:, :k]
 
-def kmeans_regularization_loss(H, k):
+    peak = U.abs().argmax(dim=0)
+    return U * torch.sign(U[peak, torch.arange(U.shape[1], device=U.device)]).detach()
+
+
+def kmeans_regularization_loss(H, k, n_oversamples=8, n_iter=2, generator=None):
       """
       Args:
         H: torch.Tensor representing the learned representation matrix.
-        F: torch.Tensor representing the cluster indicator matrix.
-        J: The original loss function (e.g., torch.nn.MSELoss()).
+        k: number of clusters, the closed-form cluster indicator F is the top-k left singular vectors of H.
+        n_oversamples: extra random directions of the randomized SVD.
+        n_iter: subspace iterations of the randomized SVD.
+        generator: torch.Generator of the random directions, see top_left_singular_vectors.
       Returns:
-        A torch.Tensor representing the combined loss.
+        A torch.Tensor representing the combined loss and the cluster of every row of H.
       """
-      U, _, _ = torch.svd(H)  # Perform SVD on H
-      F = U[:, :k]  # Get the first k singular vectors as F (closed-form solution)
+      # the SVD has no reduced-precision kernels, keep the whole loss in fp32 under mixed precision
+      with torch.autocast(device_type=H.device.type, enabled=False):
+          H = H.float()
+          # only the top-k singular vectors are needed, a randomized SVD avoids the full decomposition
+          F = top_left_singular_vectors(H, k, n_oversamples, n_iter, generator=generator)
 
-      H_t_H = torch.einsum('bd, nd-> bn', H, H)
-      trace_term = torch.trace(H_t_H)
-      F_t_H = torch.einsum('bn, bc -> bc', H_t_H, F)
-      F_t_HF = torch.einsum('bn, bc -> nc', F_t_H, F)
-      clusters = torch.argmax(F_t_H, dim=-1)
-      reg_term = torch.trace(F_t_HF)
+          # trace(H H^T) and the row sums of H H^T without forming the [b, b] Gram matrix
+          trace_term = H.pow(2).sum()
+          H_t_H_rows = H @ H.sum(dim=0)
+          F_t_H = H_t_H_rows.unsqueeze(-1) * F
+          clusters = torch.argmax(F_t_H, dim=-1)
+          reg_term = (F_t_H * F).sum()
 
       return trace_term + reg_term, clusters
 
 
+def fake_sample_index(batch_size, s_l, num_shuffle, generator=None, per_sample=False, device=None, lengths=None):
+    """
+    Time index of the fake samples: num_shuffle random time steps of a window move by a cyclic shift
+    among themselves, so none of them keeps its position, the other time steps keep theirs.
+
+    :param num_shuffle: shuffled time steps, at least 2
+    :param per_sample: draw an independent shuffle for every window instead of one for the whole batch
+    :param lengths: [batch_size] valid lengths of zero-padded windows, a window then shuffles
+        lengths * num_shuffle // s_l of its valid steps, at least 2, and the padding stays in place;
+        windows with a single valid step cannot be shuffled and keep the identity index
+    :return: [batch_size, s_l] index, or [1, s_l] shared by the batch
+    """
+    n = batch_size if per_sample or lengths is not None else 1
+    num_shuffle = min(max(num_shuffle, 2), s_l)
+
+    # argsort of uniform noise picks the steps of n windows at once, in random order
+    steps_noise = torch.rand(n, s_l, generator=generator, device=device)
+    count = torch.full((n, 1), num_shuffle, device=device)
+
+    if lengths is not None:
+        lengths = lengths.unsqueeze(-1)
+        # padded steps sort last and are never picked
+        steps_noise.masked_fill_(torch.arange(s_l, device=device) >= lengths, float("inf"))
+        count = (lengths * num_shuffle // s_l).clamp_min(2).minimum(lengths)
+
+    steps = steps_noise.argsort(dim=-1)[:, :num_shuffle]
+    # every one of the first count picked steps takes the value of the next one, the rest stay
+    slots = torch.arange(num_shuffle, device=device)
+    order = torch.where(slots < count, (slots + 1) % count, slots)
+
+    index = torch.arange(s_l, device=device).repeat(n, 1)
+    return index.scatter_(1, steps, steps.gather(1, order))
+
+
+def window_lengths(x):
+    """
+    Valid lengths of zero-padded windows: one past the last time step with a non-zero feature, at least 1.
+
+    :param x: [b, s_l, f] windows
+    :return: [b] lengths
+    """
+    steps = torch.arange(1, x.shape[1] + 1, device=x.device)
+    return ((x != 0).any(dim=-1) * steps).amax(dim=-1).clamp_min(1)
+
+
 class DTCR(nn.Module):
 
     def __init__(self, input_size,
                  d_model, n_clusters,
                  num_layers, seed,
-                 device, batch_size):
+                 device, batch_size,
+                 per_sample_shuffle=False,
+                 pack_padded=False):
 
         super(DTCR, self).__init__()
 
@@ -52,9 +119,9 @@ class DTCR(nn.Module):
         self.device = device
 
         self.encoder = nn.LSTM(input_size=input_size, hidden_size=d_model,
-                               bidirectional=True, num_layers=num_layers)
+                               bidirectional=True, num_layers=num_layers, batch_first=True)
         self.decoder = nn.LSTM(input_size=d_model*2, hidden_size=input_size,
-                               bidirectional=False, num_layers=1)
+                               bidirectional=False, num_layers=1, batch_first=True)
 
         self.proj_down = nn.Sequential(nn.Linear(d_model*2, 128),
                                        nn.Linear(128, 2))
@@ -62,47 +129,135 @@ class DTCR(nn.Module):
         self.d_model = d_model
         self.input_size = input_size
         self.n_clusters = n_clusters
+        self.scorer = ClusteringScorer(n_clusters=n_clusters)
+        self.seed = seed
+        self.per_sample_shuffle = per_sample_shuffle
+        # infer the lengths of zero-padded windows and skip their padding in the LSTMs
+        self.pack_padded = pack_padded
+        self._generator = None
 
-    def forward(self, x, y=None, compute_knn=False):
+    def _get_generator(self, device):
+        if self._generator is None or self._generator.device != device:
+            self._generator = torch.Generator(device=device).manual_seed(self.seed)
+        return self._generator
 
-        s_l = x.shape[1]
+    def _svd_generator(self, device):
+        # reseeded on every call, the same encodings always get the same random directions and clusters
+        return torch.Generator(device=device).manual_seed(self.seed)
 
+    def _as_padded(self, x, lengths):
+        if isinstance(x, PackedSequence):
+            x, lengths = pad_packed_sequence(x, batch_first=True)
+
+        b, s_l = x.shape[0], x.shape[1]
         if len(x.shape) > 3:
-            x = x.reshape(self.batch_size, s_l, -1)
+            x = x.reshape(b, s_l, -1)
+
+        if lengths is None and self.pack_padded:
+            lengths = window_lengths(x)
+
+        return x, None if lengths is None else lengths.to(x.device)
+
+    @staticmethod
+    def _pack(x, lengths):
+        if lengths is None:
+            return x
+        return pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+
+    def forward(self, x, y=None, compute_knn=False, scorer=None, lengths=None):
+        """
+        :param x: [b, s_l, f] windows, or a PackedSequence of variable-length windows
+        :param lengths: [b] valid lengths of zero-padded windows
+        """
+        x, lengths = self._as_padded(x, lengths)
+        b, s_l = x.shape[0], x.shape[1]
 
         a = 0.2  # Hyperparameter for the number of time steps to shuffle
         num_shuffle = int(a * s_l)
-        shuffle_mask = torch.randperm(s_l)[:num_shuffle]
-        x_to_shuffle = x[:, shuffle_mask, :]
-        shuffle_mask_2 = torch.randperm(num_shuffle)
-        x_to_shuffle = x_to_shuffle[:, shuffle_mask_2, :]
-        inds_no_shuffle = [idx for idx in range(s_l) if idx not in shuffle_mask]
-        x_not_shuffle = x[:, inds_no_shuffle, :]
+        shuffle_index = fake_sample_index(b, s_l, num_shuffle,
+                                          generator=self._get_generator(x.device),
+                                          per_sample=self.per_sample_shuffle,
+                                          device=x.device,
+                                          lengths=lengths)
 
-        fake_x = torch.cat([x_not_shuffle, x_to_shuffle], dim=1)
-        combined_x = torch.cat([x, fake_x], dim=0)
+        fake_x, fake_lengths = x, lengths
+        if lengths is not None:
+            # windows with a single valid step have no shuffled counterpart, they only enter as real samples
+            fake = lengths >= 2
+            fake_x, fake_lengths, shuffle_index = x[fake], lengths[fake], shuffle_index[fake]
+        n_fake = fake_x.shape[0]
 
-        x_enc, _ = self.encoder(combined_x)
+        # real windows first, then the fake ones gathered straight into the same buffer
+        combined_x = x.new_empty(b + n_fake, s_l, x.shape[-1])
+        combined_x[:b] = x
+        torch.gather(fake_x, 1, shuffle_index.unsqueeze(-1).expand(n_fake, s_l, x.shape[-1]), out=combined_x[b:])
+        combined_x = self._pack(combined_x, None if lengths is None else torch.cat([lengths, fake_lengths]))
+
+        x_enc, (h_n, _) = self.encoder(combined_x)
+        x_rec, _ = self.decoder(x_enc)
 
-        y_hat_class = self.proj_down(x_enc)
-        y_class = torch.cat([torch.zeros(self.batch_size, 2), torch.ones(self.batch_size, 2)], dim=0).to(self.device)
+        # real or fake is predicted from the final hidden states of both directions of the last layer
+        y_hat_class = self.proj_down(torch.cat([h_n[-2], h_n[-1]], dim=-1))
+        y_class = torch.cat([torch.zeros(b), torch.ones(n_fake)], dim=0).to(self.device)
         y_class = y_class.to(torch.long)
 
         class_loss = nn.CrossEntropyLoss()(y_hat_class, y_class)
 
-        x_rec, _ = self.decoder(x_enc)
-
-        x_enc_kmeans = x_enc.reshape(self.batch_size, -1)
-        kmeans_loss, labels = kmeans_regularization_loss(x_enc_kmeans, self.n_clusters)
+        if lengths is not None:
+            # the packed data holds the valid time steps only
+            rec_loss = nn.MSELoss()(x_rec.data, combined_x.data)
+            x_enc, _ = pad_packed_sequence(x_enc, batch_first=True, total_length=s_l)
+        else:
+            rec_loss = nn.MSELoss()(x_rec, combined_x).mean()
 
-        rec_loss = nn.MSELoss()(x_rec, combined_x).mean()
+        # the k-means relaxation clusters the real windows only
+        x_enc_kmeans = x_enc[:b].reshape(b, -1)
+        kmeans_loss, labels = kmeans_regularization_loss(x_enc_kmeans, self.n_clusters,
+                                                         generator=self._svd_generator(x.device))
 
         tot_loss = rec_loss + class_loss + kmeans_loss
 
         if y is not None:
             y = y[:, 0, :].reshape(-1)
-            adj_rand_index, nmi, f1, p_score = get_scores(y, k, self.n_clusters, device=self.device)
+            if scorer is not None:
+                # the relaxed k-means of every batch is its own fit, align its ids on the encodings
+                scorer.update(y, labels, features=x_enc_kmeans.detach())
+                adj_rand_index, nmi, f1, p_score = 0, 0, 0, 0
+            else:
+                adj_rand_index, nmi, f1, p_score = get_scores(y, labels, self.n_clusters, device=self.device,
+                                                              scorer=self.scorer)
         else:
             adj_rand_index, nmi, f1, p_score = 0, 0, 0, 0
 
         return tot_loss, adj_rand_index, nmi, f1, p_score, x_enc
+
+    @torch.no_grad()
+    def predict(self, x, lengths=None):
+        """
+        Argmax of the k-means relaxation over the encoded windows, without the fake samples.
+        Every batch of a DataLoader is its own relaxation, its cluster ids are aligned on the encodings
+        of the previous batches (see LabelAligner) before they are concatenated.
+
+        :param x: [b, s_l, f] batch of windows, a PackedSequence, or a DataLoader of (x, y) batches
+        :param lengths: [b] valid lengths of zero-padded windows
+        :return: [n_windows] cluster assignments
+        """
+        if isinstance(x, (torch.Tensor, PackedSequence)):
+            return self._predict_batch(x, lengths)[0]
+
+        aligner = LabelAligner(self.n_clusters)
+        return torch.cat([aligner.align(*self._predict_batch(x_batch.to(self.device))) for x_batch, _ in x])
+
+    def _predict_batch(self, x, lengths=None):
+
+        x, lengths = self._as_padded(x, lengths)
+        b, s_l = x.shape[0], x.shape[1]
+
+        x_enc, _ = self.encoder(self._pack(x, lengths))
+        if lengths is not None:
+            x_enc, _ = pad_packed_sequence(x_enc, batch_first=True, total_length=s_l)
+
+        x_enc = x_enc.reshape(b, -1)
+        _, labels = kmeans_regularization_loss(x_enc, self.n_clusters, generator=self._svd_generator(x.device))
+
+        return labels, x_enc
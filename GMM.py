@@ -1,33 +1,13 @@
+import math
 from typing import Iterator, List
 from abc import ABC, abstractmethod
 
-import numpy as np
-from sklearn import metrics
-from torchmetrics.clustering import AdjustedRandScore, NormalizedMutualInfoScore
-from torchmetrics import Accuracy, F1Score
-
 import torch
 from enum import Enum
-from torch.distributions import (
-    Normal,
-    Categorical,
-    Independent,
-    MultivariateNormal,
-    MixtureSameFamily
-)
 from torch.distributions.utils import logits_to_probs
-import torch
 import numpy
-from sklearn.datasets import make_spd_matrix
-
-from util_scores import get_scores
 
-
-def purity_score(y_true, y_pred):
-    # compute contingency matrix (also called confusion matrix)
-    contingency_matrix = metrics.cluster.contingency_matrix(y_true, y_pred)
-    # return purity
-    return np.sum(np.amax(contingency_matrix, axis=0)) / np.sum(contingency_matrix)
+from util_scores import ClusteringScorer, get_scores
 
 
 def make_random_scale_trils(num_sigmas: int, num_dims: int) -> torch.Tensor:
@@ -133,9 +113,44 @@ class MixtureModel(ABC, torch.nn.Module):
         return logits_to_probs(self.logits)
 
     @abstractmethod
-    def forward(self, x: torch.Tensor, y:torch.Tensor):
+    def forward(self, x: torch.Tensor, y: torch.Tensor = None):
         raise NotImplementedError()
 
+    @abstractmethod
+    def log_responsibilities(self, x: torch.Tensor):
+        raise NotImplementedError()
+
+    @staticmethod
+    def _assign(log_resp):
+        # most likely component of every time step, then the most frequent one of each window
+        cluster_assign = torch.argmax(log_resp, dim=-1)
+        return torch.mode(cluster_assign, dim=-1).values
+
+    def get_cluster_assign(self, x):
+
+        with torch.no_grad():
+            log_resp, _ = self.log_responsibilities(x)
+            return self._assign(log_resp)
+
+    @torch.no_grad()
+    def predict(self, x):
+        """
+        Component with the highest responsibility, by majority over the time steps of each window.
+
+        :param x: [b, s_l, f] batch of windows, or a DataLoader of (x, y) batches
+        :return: [n_windows] cluster assignments
+        """
+        if not isinstance(x, torch.Tensor):
+            return torch.cat([self.predict(x_batch.to(self.device)) for x_batch, _ in x])
+
+        b, s_l = x.shape[0], x.shape[1]
+        if len(x.shape) > 3:
+            x = x.reshape(b, s_l, -1)
+
+        x = self.embed(x)
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return self.get_cluster_assign(x.float())
+
     @abstractmethod
     def constrain_parameters(self):
         raise NotImplementedError()
@@ -150,13 +165,22 @@ class MixtureModel(ABC, torch.nn.Module):
 
 
 class GmmFull(MixtureModel):
+    """
+    Implements full covariance gaussian mixture model, parameterized by the cholesky factors
+    of the component covariances
+
+    :param num_components: number of components
+    """
+
     def __init__(
             self,
             num_components: int,
             num_dims: int,
             num_feat: int,
+            device,
             init_radius: float = 1.0,
-            init_mus: List[List[float]] = None
+            init_mus: List[List[float]] = None,
+            epsilon: float = 1e-6
     ):
         super().__init__(num_components, num_dims, init_radius)
 
@@ -168,46 +192,86 @@ class GmmFull(MixtureModel):
         self.embed = torch.nn.Linear(num_feat, num_dims, bias=False)
         self.mus = torch.nn.Parameter(init_mus)
 
-        # lower triangle representation of (symmetric) covariance matrix
-
+        # unconstrained cholesky factors, the diagonal goes through a softplus so it stays positive
         lower_triangular = torch.tril(torch.rand(num_dims, num_dims))
+        diagonal = lower_triangular.diagonal().clamp_min(epsilon)
+        lower_triangular = lower_triangular + torch.diag_embed(torch.log(torch.expm1(diagonal)) - diagonal)
+        self.scale_tril_raw = torch.nn.Parameter(lower_triangular.repeat(num_components, 1, 1))
 
-        # Step 2: Make it positive definite
-        diagonal_matrix = torch.diag(torch.ones(num_dims))  # Identity matrix
-
-        epsilon = 1e-6  # Small constant to ensure positive definiteness
+        self.epsilon = epsilon
+        self.n_clusters = num_components
+        self.device = device
+        self.scorer = ClusteringScorer(n_clusters=num_components)
 
-        positive_definite_matrix = lower_triangular @ lower_triangular.t() + diagonal_matrix * epsilon
-        sigmas = [positive_definite_matrix for i in range(self.num_components)]
-        sigmas = torch.stack(sigmas)
+    @property
+    def scale_tril(self) -> torch.Tensor:
+        """[num_components, num_dims, num_dims] cholesky factors with a positive diagonal"""
+        diagonal = torch.nn.functional.softplus(self.scale_tril_raw.diagonal(dim1=-2, dim2=-1)) + self.epsilon
+        return torch.tril(self.scale_tril_raw, diagonal=-1) + torch.diag_embed(diagonal)
 
-        self.scale_tril = torch.nn.Parameter(sigmas)
+    def forward(self, x: torch.Tensor, y: torch.Tensor = None, scorer=None):
+        b, s_l = x.shape[0], x.shape[1]
 
-    def forward(self, x: torch.Tensor):
+        if len(x.shape) > 3:
+            x = x.reshape(b, s_l, -1)
 
         x = self.embed(x)
-        mixture = Categorical(logits=self.logits)
-        components = MultivariateNormal(self.mus, self.scale_tril)
-        mixture_model = MixtureSameFamily(mixture, components)
 
-        nll_loss = -1 * mixture_model.log_prob(x).mean()
+        # the triangular solve has no reduced-precision kernels, log-probs are computed in fp32
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = x.float()
+            log_resp, log_prob = self.log_responsibilities(x)
+            assigned_labels = self._assign(log_resp.detach())
+        nll_loss = -1 * log_prob.mean()
 
-        return nll_loss
+        if y is not None:
+            y = y[:, 0, :].reshape(-1)
+            if scorer is not None:
+                scorer.update(y, assigned_labels)
+                adj_rand_index, nmi, f1, p_score = 0, 0, 0, 0
+            else:
+                adj_rand_index, nmi, f1, p_score = get_scores(y, assigned_labels, self.n_clusters, device=self.device,
+                                                              scorer=self.scorer)
+        else:
+            adj_rand_index, nmi, f1, p_score = 0, 0, 0, 0
 
-    def constrain_parameters(self, epsilon: float = 1e-6):
-        with torch.no_grad():
-            for tril in self.scale_tril:
-                # cholesky decomposition requires positive diagonal
-                tril.diagonal().abs_()
+        return nll_loss, adj_rand_index, nmi, f1, p_score, x
 
-                # diagonal cannot be too small (singularity collapse)
-                tril.diagonal().clamp_min_(epsilon)
+    def log_responsibilities(self, x: torch.Tensor):
+        """
+        Log-likelihood of every sample under every component with one triangular solve
+        batched over the components.
+
+        :param x: [..., num_dims] embedded samples
+        :return: [..., num_components] log p(k | x) and [...] log p(x)
+        """
+        batch_shape = x.shape[:-1]
+        scale_tril = self.scale_tril
+
+        # [num_components, num_dims, N] centered samples, whitened by L^-1
+        diff = (x.reshape(1, -1, self.num_dims) - self.mus.unsqueeze(1)).mT
+        whitened = torch.linalg.solve_triangular(scale_tril, diff, upper=False)
+        maha = whitened.pow(2).sum(dim=1).T
+
+        log_det = torch.log(scale_tril.diagonal(dim1=-2, dim2=-1)).sum(-1)
+        log_norm = -log_det - 0.5 * self.num_dims * math.log(2 * math.pi)
+
+        log_joint = torch.log_softmax(self.logits, dim=-1) + log_norm - 0.5 * maha
+        log_prob = torch.logsumexp(log_joint, dim=-1)
+
+        log_resp = log_joint - log_prob.unsqueeze(-1)
+        return log_resp.reshape(*batch_shape, -1), log_prob.reshape(batch_shape)
+
+    def constrain_parameters(self, epsilon: float = 1e-6):
+        # the softplus parameterization keeps the cholesky diagonal positive, nothing to project
+        pass
 
     def component_parameters(self) -> Iterator[torch.nn.Parameter]:
-        return iter([self.mus, self.scale_tril])
+        return iter([self.mus, self.scale_tril_raw])
 
     def get_covariance_matrix(self) -> torch.Tensor:
-        return self.scale_tril @ self.scale_tril.mT
+        scale_tril = self.scale_tril
+        return scale_tril @ scale_tril.mT
 
 
 class GmmDiagonal(MixtureModel):
@@ -215,6 +279,7 @@ class GmmDiagonal(MixtureModel):
     Implements diagonal gaussian mixture model
 
     :param num_components: number of components
+    :param use_em: fit the mixture with one closed-form EM step per training batch instead of gradients
     """
 
     def __init__(
@@ -224,7 +289,8 @@ class GmmDiagonal(MixtureModel):
             num_feat: int,
             device,
             init_radius: float = 1.0,
-            init_mus: List[List[float]] = None
+            init_mus: List[List[float]] = None,
+            use_em: bool = False
     ):
         super().__init__(num_components, num_dims, init_radius)
 
@@ -239,44 +305,91 @@ class GmmDiagonal(MixtureModel):
         self.sigmas_diag = torch.nn.Parameter(torch.rand(num_components, num_dims))
         self.n_clusters = num_components
         self.device = device
+        self.scorer = ClusteringScorer(n_clusters=num_components)
+
+        # with EM the mixture parameters are set in closed form, only the embedding gets gradients
+        self.use_em = use_em
+        if use_em:
+            for param in [self.logits, *self.component_parameters()]:
+                param.requires_grad_(False)
 
-    def forward(self, x: torch.Tensor, y: torch.Tensor):
+    def forward(self, x: torch.Tensor, y: torch.Tensor = None, scorer=None):
         b, s_l = x.shape[0], x.shape[1]
 
         if len(x.shape) > 3:
             x = x.reshape(b, s_l, -1)
 
         x = self.embed(x)
-        mixture = Categorical(logits=self.logits)
-        components = Independent(Normal(self.mus, self.sigmas_diag), 1)
-        mixture_model = MixtureSameFamily(mixture, components)
 
-        prob = mixture_model.log_prob(x)
+        # log-probs are computed in fp32 under mixed precision
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = x.float()
+            if self.use_em and self.training:
+                self.em_step(x.detach())
 
-        assigned_labels = self.get_cluster_assign(x)
-        nll_loss = -1 * prob.mean()
+            log_resp, log_prob = self.log_responsibilities(x)
+            assigned_labels = self._assign(log_resp.detach())
+        nll_loss = -1 * log_prob.mean()
 
         if y is not None:
             y = y[:, 0, :].reshape(-1)
-            adj_rand_index, nmi, f1, p_score = get_scores(y, k, self.n_clusters, device=self.device)
+            if scorer is not None:
+                scorer.update(y, assigned_labels)
+                adj_rand_index, nmi, f1, p_score = 0, 0, 0, 0
+            else:
+                adj_rand_index, nmi, f1, p_score = get_scores(y, assigned_labels, self.n_clusters, device=self.device,
+                                                              scorer=self.scorer)
         else:
             adj_rand_index, nmi, f1, p_score = 0, 0, 0, 0
 
         return nll_loss, adj_rand_index, nmi, f1, p_score, x
 
-    def get_cluster_assign(self, x):
+    def log_responsibilities(self, x: torch.Tensor, chunk_size: int = 4096):
+        """
+        Log-likelihood of every sample under every component, shared by the loss and the cluster assignment.
+        The squared distances are taken on the differences x - mu, chunked over the samples to bound
+        the [chunk, num_components, num_dims] intermediate; expanding the square cancels catastrophically
+        in fp32 once the standard deviations get small.
+
+        :param x: [..., num_dims] embedded samples
+        :param chunk_size: samples per chunk of the squared distances
+        :return: [..., num_components] log p(k | x) and [...] log p(x)
+        """
+        batch_shape = x.shape[:-1]
+        inv_std = self.sigmas_diag.reciprocal()
 
-        probs = []
+        maha = torch.cat([((chunk.unsqueeze(-2) - self.mus) * inv_std).pow(2).sum(-1)
+                          for chunk in x.reshape(-1, self.num_dims).split(chunk_size)])
+        maha = maha.reshape(*batch_shape, self.num_components)
+        log_norm = -torch.log(self.sigmas_diag.abs()).sum(-1) - 0.5 * self.num_dims * math.log(2 * math.pi)
 
-        with torch.no_grad():
-            for i in range(self.num_components):
-                component = Independent(Normal(self.mus[i], self.sigmas_diag[i]), 1)
-                prob = component.log_prob(x)
-                probs.append(prob)
-            log_probs = torch.stack(probs, dim=-1)
-            cluster_assign = torch.argmax(log_probs, dim=-1)
-            cluster_assign = torch.mode(cluster_assign, dim=-1).values
-            return cluster_assign
+        log_joint = torch.log_softmax(self.logits, dim=-1) + log_norm - 0.5 * maha
+        log_prob = torch.logsumexp(log_joint, dim=-1)
+
+        return log_joint - log_prob.unsqueeze(-1), log_prob
+
+    @torch.no_grad()
+    def em_step(self, x: torch.Tensor, epsilon: float = 1e-6):
+        """
+        One EM iteration with closed-form diagonal updates: responsibilities of x under the current
+        parameters, then the weighted means, standard deviations and mixture weights.
+        Components without responsibility keep their parameters.
+
+        :param x: [..., num_dims] embedded samples
+        """
+        x = x.reshape(-1, self.num_dims)
+        resp = self.log_responsibilities(x)[0].exp()
+
+        counts = resp.sum(dim=0)
+        active = (counts > epsilon).unsqueeze(-1)
+        counts = counts.clamp_min(epsilon).unsqueeze(-1)
+
+        mus = resp.T @ x / counts
+        var = resp.T @ x.pow(2) / counts - mus.pow(2)
+
+        self.mus.copy_(torch.where(active, mus, self.mus))
+        self.sigmas_diag.copy_(torch.where(active, var.clamp_min(epsilon ** 2).sqrt(), self.sigmas_diag))
+        self.logits.copy_(torch.log(counts.squeeze(-1) / counts.sum()))
 
     def constrain_parameters(self, epsilon: float = 1e-6):
         with torch.no_grad():
@@ -298,13 +411,15 @@ def get_model(
         mixture_family: MixtureFamily,
         num_components: int,
         num_dims: int,
-        radius: float
+        num_feat: int,
+        device,
+        radius: float = 1.0
 ) -> torch.nn.Module:
     if mixture_family == MixtureFamily.FULL:
-        return GmmFull(num_components, num_dims, radius)
+        return GmmFull(num_components, num_dims, num_feat, device, init_radius=radius)
 
     if mixture_family == MixtureFamily.DIAGONAL:
-        return GmmDiagonal(num_components, num_dims, radius)
+        return GmmDiagonal(num_components, num_dims, num_feat, device, init_radius=radius)
 
     raise NotImplementedError(
         f"Mixture family {mixture_family.value} not implemented yet"
@@ -1,56 +1,104 @@
-import statistics
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import pandas as pd
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 import torch
-import numpy as np
 import os
-from sklearn import metrics
-from torchmetrics.clustering import AdjustedRandScore, NormalizedMutualInfoScore
-from torchmetrics import F1Score
+from elastic_kmeans import DTWKMeans, KShape
 from seed_manager import set_seed
+from util_scores import ClusteringScorer
+
+# --model_name of every baseline and the metric it clusters with
+BASELINE_METRICS = {"kmeans": "euclidean", "dtw_kmeans": "dtw", "kshape": "kshape"}
+BASELINE_NAMES = {metric: name for name, metric in BASELINE_METRICS.items()}
+
+
+def fit_predict_batch(x, n_clusters, seed=1234, metric="euclidean", radius=None, n_jobs=1):
+    """
+    Clusters one batch of windows, module level so process pools can pickle it.
 
+    :param x: [b, s_l, f] windows
+    :param metric: euclidean (KMeans on flattened windows), dtw (DTWKMeans) or kshape (KShape)
+    :param radius: Sakoe-Chiba radius of dtw, None for 10% of the window
+    :param n_jobs: joblib workers of the dtw and kshape engines
+    """
+    if metric == "dtw":
+        return DTWKMeans(n_clusters, radius=radius, n_jobs=n_jobs, seed=seed).fit_predict(x)
+    if metric == "kshape":
+        return KShape(n_clusters, n_jobs=n_jobs, seed=seed).fit_predict(x)
 
-def purity_score(y_true, y_pred):
-    # compute contingency matrix (also called confusion matrix)
-    contingency_matrix = metrics.cluster.contingency_matrix(y_true, y_pred)
-    # return purity
-    return np.sum(np.amax(contingency_matrix, axis=0)) / np.sum(contingency_matrix)
+    kmeans = KMeans(n_clusters=n_clusters, random_state=seed, n_init="auto").fit(x.reshape(len(x), -1))
+    return kmeans.labels_
 
 
 class Kmeans:
-    def __init__(self, n_clusters, batch_size, data_loader, seed, exp_name):
+    """
+    k-means baselines on windows, scored with one contingency table over the split.
+
+    :param mode: per_batch fits one model per batch, streaming fits a single MiniBatchKMeans
+        over the whole split in one pass and assigns every batch with it (euclidean only)
+    :param n_workers: processes fitting the per-batch euclidean models in parallel,
+        joblib workers inside the dtw and kshape engines
+    :param metric: euclidean, dtw or kshape, see fit_predict_batch
+    :param radius: Sakoe-Chiba radius of dtw, None for 10% of the window
+    """
+    def __init__(self, n_clusters, batch_size, data_loader, seed, exp_name, mode="per_batch", n_workers=1,
+                 metric="euclidean", radius=None):
+
+        if mode == "streaming" and metric != "euclidean":
+            raise ValueError(f"streaming mode only supports the euclidean metric, got `{metric}`")
 
         set_seed(seed)
         self.n_clusters = n_clusters
         self.batch_size = batch_size
+        self.seed = seed
+        self.metric = metric
+        self.radius = radius
+        self.n_workers = n_workers
+        self.kmeans = None
+
+        # one contingency table over every test batch
+        scorer = ClusteringScorer(n_clusters=self.n_clusters)
+
+        if mode == "streaming":
+            self.fit_streaming(data_loader)
+            for x, y in data_loader:
+                scorer.update(y[:, 0, :].reshape(-1), self.predict(x))
+
+        elif n_workers > 1 and metric == "euclidean":
+            # a single pass, the loaders may sample their batches at random
+            labels, batches = [], []
+            for x, y in data_loader:
+                labels.append(y[:, 0, :].reshape(-1))
+                batches.append(x.reshape(x.shape[0], -1).cpu().numpy())
+
+            fit_predict = partial(fit_predict_batch, n_clusters=n_clusters, seed=seed)
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                for y, x, assigned_labels in zip(labels, batches, executor.map(fit_predict, batches)):
+                    # every batch is its own fit, its cluster ids are aligned before they are pooled
+                    scorer.update(y, torch.from_numpy(assigned_labels).to(torch.long),
+                                  features=torch.from_numpy(x))
+        else:
+            for x, y in data_loader:
 
-        tot_adj_loss = []
-        tot_acc_loss = []
-        tot_nmi_loss = []
-        tot_p_loss = []
-
-        for x, y in data_loader:
-
-            adj, nmi, acc, p_score = self.predict(x, y)
-            tot_adj_loss.append(adj.item())
-            tot_acc_loss.append(acc.item())
-            tot_nmi_loss.append(nmi.item())
-            tot_p_loss.append(p_score.item())
+                assigned_labels = self.predict(x)
+                # every batch is its own fit, its cluster ids are aligned before they are pooled
+                scorer.update(y[:, 0, :].reshape(-1), assigned_labels, features=self.alignment_features(x))
 
-        adj = statistics.mean(tot_adj_loss)
-        nmi = statistics.mean(tot_nmi_loss)
-        f1 = statistics.mean(tot_acc_loss)
-        p_score = statistics.mean(tot_p_loss)
+        adj, nmi, f1, p_score = [score.item() for score in scorer.compute()]
+        acc = scorer.accuracy().item()
 
-        print("adj rand index {:.3f}, nmi {:.3f}, f1 {:.3f}, p_score {:.3f}".format(adj, nmi, f1, p_score))
+        print("adj rand index {:.3f}, nmi {:.3f}, f1 {:.3f}, p_score {:.3f}, acc {:.3f}".format(adj, nmi, f1, p_score, acc))
 
         # Specify the file path
         file_path = "final_scores_{}_{}.csv".format(exp_name, seed)
 
-        scores = {f"kmeans_{exp_name}": {'adj': f"{adj:.3f}",
+        scores = {f"{BASELINE_NAMES[metric]}_{exp_name}": {'adj': f"{adj:.3f}",
                                     'f1': f"{f1: .3f}",
                                     'nmi': f"{nmi: .3f}",
-                                    'p_score': f"{p_score: .3f}"}}
+                                    'p_score': f"{p_score: .3f}",
+                                    'acc': f"{acc: .3f}"}}
 
         df = pd.DataFrame.from_dict(scores, orient='index')
 
@@ -62,20 +110,30 @@ class Kmeans:
         else:
             df.to_csv(file_path)
 
-    def predict(self, x, y):
-
-        x = x.reshape(self.batch_size, -1)
-        kmeans = KMeans(n_clusters=self.n_clusters, random_state=1234, n_init="auto").fit(x)
-        labels = kmeans.labels_
+    def fit_streaming(self, data_loader):
+        """Fits a single MiniBatchKMeans with one partial_fit per batch of the split."""
+        self.kmeans = MiniBatchKMeans(n_clusters=self.n_clusters, random_state=self.seed,
+                                      batch_size=self.batch_size, n_init="auto")
+        for x, _ in data_loader:
+            self.kmeans.partial_fit(x.reshape(x.shape[0], -1).cpu().numpy())
+
+    def alignment_features(self, x):
+        """Flattened windows in the space the per-batch fits cluster, their centroids align the cluster ids."""
+        x = x.reshape(x.shape[0], x.shape[1], -1).cpu().double()
+        if self.metric == "kshape":
+            # k-Shape clusters z-normalized windows, amplitude and offset do not tell its clusters apart
+            std = x.std(1, unbiased=False, keepdim=True)
+            x = (x - x.mean(1, keepdim=True)) / torch.where(std == 0, torch.ones_like(std), std)
+        return x.reshape(x.shape[0], -1)
+
+    def predict(self, x):
+
+        x = x.reshape(x.shape[0], x.shape[1], -1).cpu().numpy()
+        if self.kmeans is not None:
+            labels = self.kmeans.predict(x.reshape(len(x), -1))
+        else:
+            labels = fit_predict_batch(x, self.n_clusters, self.seed, metric=self.metric,
+                                       radius=self.radius, n_jobs=self.n_workers)
         assigned_labels = torch.from_numpy(labels).to(torch.long)
-        y = y[:, 0, :].reshape(-1).to(torch.long)
-
-        adj_rand_index = AdjustedRandScore()(assigned_labels, y)
-        nmi = NormalizedMutualInfoScore()(assigned_labels, y)
-        acc = F1Score(task='multiclass', num_classes=self.n_clusters)(assigned_labels, y)
-        p_score = purity_score(y.detach().numpy(), assigned_labels.detach().numpy())
-
-        return adj_rand_index, nmi, acc, p_score
-
-
 
+        return assigned_labels
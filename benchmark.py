@@ -0,0 +1,126 @@
+import argparse
+import time
+
+import torch
+
+from deepclustering import DeepClustering
+from forecasting_models.Autoformer import AutoCorrelation
+from modules.multi_head_attn import ATTENTION_REGISTRY, MultiHeadAttention, build_attention
+from seed_manager import set_seed
+
+
+def steps_per_sec(step, n_steps, n_warmup=2):
+
+    for _ in range(n_warmup):
+        step()
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        step()
+    return n_steps / (time.perf_counter() - start)
+
+
+def benchmark_attention(args):
+    """
+    Training steps/sec of MultiHeadAttention for every attn_type, comparing the persistent
+    kernel against constructing a fresh kernel on every forward pass.
+    """
+    print("attn_type, per_call steps/s, persistent steps/s, speedup")
+
+    for attn_type in ATTENTION_REGISTRY.keys():
+
+        set_seed(args.seed)
+        mha = MultiHeadAttention(d_model=args.d_model, n_heads=args.nheads,
+                                 attn_type=attn_type, seed=args.seed, device=args.device,
+                                 attn_backend=args.attn_backend, attn_version=args.attn_version).to(args.device)
+        mha.train()
+        x = torch.randn(args.batch_size, args.seq_len, args.d_model, device=args.device)
+
+        def persistent_step():
+            mha.zero_grad()
+            mha(x, x, x).mean().backward()
+
+        def per_call_step():
+            mha.zero_grad()
+            attention, _ = build_attention(attn_type, mha.d_k, mha.n_heads, args.seed, args.device,
+                                           backend=args.attn_backend, attn_version=args.attn_version)
+            mha.attention = attention.to(args.device)
+            mha(x, x, x).mean().backward()
+
+        per_call = steps_per_sec(per_call_step, args.n_steps)
+        persistent = steps_per_sec(persistent_step, args.n_steps)
+
+        print("{}, {:.2f}, {:.2f}, {:.2f}x".format(attn_type, per_call, persistent, persistent / per_call))
+
+
+def benchmark_autocorrelation(args):
+    """
+    Milliseconds per call of the three AutoCorrelation time-delay aggregations on args.device
+    for sequence lengths between 96 and 2048.
+    """
+    autocorrelation = AutoCorrelation(seed=args.seed)
+    d_k = args.d_model // args.nheads
+
+    print("seq_len, training ms, inference ms, full ms")
+
+    for seq_len in [96, 192, 384, 768, 1536, 2048]:
+
+        values = torch.randn(args.batch_size, args.nheads, d_k, seq_len, device=args.device)
+        corr = torch.randn(args.batch_size, args.nheads, d_k, seq_len, device=args.device)
+
+        timings = []
+        for agg in [autocorrelation.time_delay_agg_training,
+                    autocorrelation.time_delay_agg_inference,
+                    autocorrelation.time_delay_agg_full]:
+            with torch.no_grad():
+                timings.append(1000 / steps_per_sec(lambda: agg(values, corr), args.n_steps))
+
+        print("{}, {:.2f}, {:.2f}, {:.2f}".format(seq_len, *timings))
+
+
+def benchmark_reconstruction(args):
+    """
+    Milliseconds per forward and backward of the DeepClustering batch reconstruction,
+    legacy einsum (rec_version=1) against the scores @ x_enc_re matmul (rec_version=2).
+    """
+    print("rec_version, ms")
+
+    for rec_version in [1, 2]:
+
+        set_seed(args.seed)
+        model = DeepClustering(input_size=args.input_size, knns=5, d_model=args.d_model, nheads=args.nheads,
+                               n_clusters=4, num_layers=1, attn_type="basic", seed=args.seed,
+                               device=args.device, pred_len=0, batch_size=args.batch_size,
+                               rec_version=rec_version).to(args.device)
+        x = torch.randn(args.batch_size, args.seq_len, args.input_size, device=args.device)
+
+        def step():
+            model.zero_grad()
+            model(x)[0].backward()
+
+        print("{}, {:.2f}".format(rec_version, 1000 / steps_per_sec(step, args.n_steps)))
+
+
+BENCHMARKS = {
+    "attention": benchmark_attention,
+    "autocorrelation": benchmark_autocorrelation,
+    "reconstruction": benchmark_reconstruction,
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="benchmark args")
+    parser.add_argument("--suite", choices=list(BENCHMARKS.keys()), default="attention")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--seq_len", type=int, default=96)
+    parser.add_argument("--d_model", type=int, default=32)
+    parser.add_argument("--input_size", type=int, default=4)
+    parser.add_argument("--nheads", type=int, default=8)
+    parser.add_argument("--n_steps", type=int, default=10)
+    parser.add_argument("--attn_backend", choices=['einsum', 'sdpa'], default='einsum')
+    parser.add_argument("--attn_version", type=int, choices=[1, 2], default=1)
+
+    args = parser.parse_args()
+    BENCHMARKS[args.suite](args)
@@ -2,28 +2,81 @@ import numpy as np
 import random
 import torch.nn as nn
 import torch
-from sklearn.cluster import KMeans
+import torch.nn.functional as F
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import DotProduct, WhiteKernel
 from sklearn.neighbors import NearestNeighbors
 
+from torch.utils.checkpoint import checkpoint
+
 from modules.transformer import Transformer
-from sklearn import metrics
-from torchmetrics.clustering import AdjustedRandScore, NormalizedMutualInfoScore
-from torchmetrics import Accuracy, F1Score
 from tslearn.metrics import SoftDTWLossPyTorch
 
 from seed_manager import set_seed
-from util_scores import get_scores
+from torch_kmeans import TorchKMeans
+from util_scores import ClusteringScorer, get_scores
 
 torch.autograd.set_detect_anomaly(True)
 
 
-def purity_score(y_true, y_pred):
-    # compute contingency matrix (also called confusion matrix)
-    contingency_matrix = metrics.cluster.contingency_matrix(y_true, y_pred)
-    # return purity
-    return np.sum(np.amax(contingency_matrix, axis=0)) / np.sum(contingency_matrix)
+def _run_block(fn, *args):
+    # recompute the block in backward so only its inputs and output are kept alive
+    if torch.is_grad_enabled():
+        return checkpoint(fn, *args, use_reentrant=False)
+    return fn(*args)
+
+
+def _block_scores(queries, q_start, keys, k_start, scale):
+    # fp32 scores of the windows starting at q_start against the windows starting at k_start,
+    # a window is excluded from itself with a finite minimum so a fully masked block stays differentiable
+    scores = (queries @ keys.transpose(0, 1)).float() * scale
+    is_self = torch.arange(q_start, q_start + queries.shape[0], device=queries.device).unsqueeze(-1) == \
+        torch.arange(k_start, k_start + keys.shape[0], device=queries.device).unsqueeze(0)
+    return scores.masked_fill(is_self, torch.finfo(scores.dtype).min)
+
+
+def blocked_batch_attention(x, scale, block_size):
+    """
+    softmax(x @ x.T * scale, self excluded) @ x computed over blocks of block_size key windows,
+    peak memory is O(B * block_size) instead of O(B^2) in both forward and backward.
+
+    :param x: [B, D] flattened window encodings
+    :return: [B, D] reconstruction of each window from the other windows
+    """
+    starts = range(0, x.shape[0], block_size)
+
+    # pass 1: row-wise log-sum-exp over all key blocks
+    lse = torch.stack([_run_block(lambda q, k, st=st: torch.logsumexp(_block_scores(q, 0, k, st, scale), dim=-1),
+                                  x, x[st:st + block_size])
+                       for st in starts], dim=-1)
+    lse = torch.logsumexp(lse, dim=-1, keepdim=True)
+
+    # pass 2: normalized block weights applied to the block values
+    def weighted_values(q, k, row_lse, st):
+        return torch.exp(_block_scores(q, 0, k, st, scale) - row_lse).to(k.dtype) @ k
+
+    x_rec = 0
+    for st in starts:
+        x_rec = x_rec + _run_block(lambda q, k, row_lse, st=st: weighted_values(q, k, row_lse, st),
+                                   x, x[st:st + block_size], lse)
+    return x_rec
+
+
+def topk_batch_attention(x, scale, k, block_size):
+    """
+    Approximates blocked_batch_attention by restricting every window's softmax to its
+    k most similar windows, query windows are processed block_size at a time.
+
+    :param x: [B, D] flattened window encodings
+    :return: [B, D] reconstruction of each window from its k nearest windows
+    """
+    def reconstruct(q, keys, st):
+        scores, neighbors = torch.topk(_block_scores(q, st, keys, 0, scale), k=k, dim=-1)
+        weights = torch.softmax(scores, dim=-1).to(keys.dtype)
+        return torch.einsum('qk,qkd->qd', weights, keys[neighbors])
+
+    return torch.cat([_run_block(lambda q, keys, st=st: reconstruct(q, keys, st), x[st:st + block_size], x)
+                      for st in range(0, x.shape[0], block_size)], dim=0)
 
 
 class Autoencoder(nn.Module):
@@ -52,7 +105,10 @@ class DeepClustering(nn.Module):
                  d_model, nheads, n_clusters,
                  num_layers, attn_type, seed,
                  device, pred_len, batch_size,
-                 var=1, gamma=0.1, use_knns=False):
+                 var=1, gamma=0.1, use_knns=False, attn_backend="einsum",
+                 share_layers=False, use_checkpoint=False,
+                 enc_ratio=0.25, encoder_only=False, block_size=None, rec_version=2,
+                 kmeans_warm_start=True, attn_version=1):
 
         super(DeepClustering, self).__init__()
 
@@ -62,7 +118,13 @@ class DeepClustering(nn.Module):
 
         self.seq_model = Transformer(input_size=input_size, d_model=d_model,
                                      nheads=nheads, num_layers=num_layers,
-                                     attn_type=attn_type, seed=seed, device=device)
+                                     attn_type=attn_type, seed=seed, device=device,
+                                     attn_backend=attn_backend,
+                                     share_layers=share_layers,
+                                     use_checkpoint=use_checkpoint,
+                                     enc_ratio=enc_ratio,
+                                     encoder_only=encoder_only,
+                                     attn_version=attn_version)
 
         self.proj_down = nn.Linear(d_model, input_size)
 
@@ -76,8 +138,27 @@ class DeepClustering(nn.Module):
         self.k = knns
         self.gamma = gamma
         self.use_knns = use_knns
+        self.attn_backend = attn_backend
+        # number of windows per block of the batch similarity, None computes it in one dense matrix
+        self.block_size = block_size
+
+        # 1: legacy reconstruction einsum('bd, bc-> bd') that only rescales every window by its score sum,
+        # 2: neighbour-weighted reconstruction scores @ x_enc_re. Checkpoints without the buffer are version 1.
+        self.rec_version = rec_version
+        self.register_buffer("_rec_version", torch.tensor(rec_version))
+        self._register_load_state_dict_pre_hook(self._load_rec_version)
 
-    def forward(self, x, y=None):
+        # cluster assignment of the reconstructions, the centroids are part of the state dict
+        self.kmeans = TorchKMeans(n_clusters=n_clusters, warm_start=kmeans_warm_start, seed=seed)
+        self.scorer = ClusteringScorer(n_clusters=n_clusters)
+
+    def _load_rec_version(self, state_dict, prefix, *args):
+        key = prefix + "_rec_version"
+        if key not in state_dict:
+            state_dict[key] = torch.tensor(1)
+        self.rec_version = int(state_dict[key])
+
+    def forward(self, x, y=None, scorer=None):
 
         s_l = x.shape[1]
         if len(x.shape) > 3:
@@ -86,12 +167,36 @@ class DeepClustering(nn.Module):
         x_enc = self.seq_model(x)
 
         x_enc_re = x_enc.reshape(self.batch_size, -1)
-        attn_score = torch.einsum('bl, cl-> bc', x_enc_re, x_enc_re) / np.sqrt(self.d_model * s_l)
-        mask = torch.zeros_like(attn_score).fill_diagonal_(1).to(torch.bool)
-        attn_score = attn_score.masked_fill(mask, value=-torch.inf)
-        scores = torch.softmax(attn_score, dim=-1)
+        scale = 1 / np.sqrt(self.d_model * s_l)
+
+        if self.rec_version == 1:
+            attn_score = torch.einsum('bl, cl-> bc', x_enc_re, x_enc_re) / np.sqrt(self.d_model * s_l)
+            mask = torch.zeros_like(attn_score).fill_diagonal_(1).to(torch.bool)
+            attn_score = attn_score.masked_fill(mask, value=-torch.inf)
+            scores = torch.softmax(attn_score.float(), dim=-1)
+
+            x_rec = torch.einsum('bd, bc-> bd', x_enc_re, scores)
+        elif self.use_knns:
+            # softmax restricted to the knns most similar windows of the batch
+            x_rec = topk_batch_attention(x_enc_re, scale, k=min(self.k, self.batch_size - 1),
+                                         block_size=self.block_size or self.batch_size)
+        elif self.block_size is not None:
+            x_rec = blocked_batch_attention(x_enc_re, scale, block_size=self.block_size)
+        elif self.attn_backend == "sdpa":
+            # fused batch-by-batch attention, every window is reconstructed from the other windows
+            # (scores @ x_enc_re), only a boolean mask excluding the window itself is materialized
+            not_self = ~torch.eye(self.batch_size, dtype=torch.bool, device=x_enc_re.device)
+            x_rec = F.scaled_dot_product_attention(x_enc_re.unsqueeze(0), x_enc_re.unsqueeze(0),
+                                                   x_enc_re.unsqueeze(0), attn_mask=not_self,
+                                                   scale=scale).squeeze(0)
+        else:
+            attn_score = (x_enc_re @ x_enc_re.transpose(0, 1)) * scale
+            attn_score = attn_score.fill_diagonal_(-torch.inf)
+            # softmax over the whole batch stays in fp32 under mixed precision
+            scores = torch.softmax(attn_score.float(), dim=-1)
+
+            x_rec = scores.to(x_enc_re.dtype) @ x_enc_re
 
-        x_rec = torch.einsum('bd, bc-> bd', x_enc_re, scores)
         x_rec = x_rec.reshape(x_enc.shape)
         x_rec_proj = self.proj_down(x_rec)
         if self.var == 1:
@@ -177,15 +282,19 @@ class DeepClustering(nn.Module):
         #
         if y is not None:
 
-            x_rec_knn = x_rec_proj.cpu().detach().numpy()
-            x_rec_knn = x_rec_knn.reshape(self.batch_size, -1)
-            kmeans = KMeans(n_clusters=self.n_clusters, random_state=1234, n_init="auto").fit(x_rec_knn)
-            labels = kmeans.labels_
-            assigned_labels = torch.from_numpy(labels).to(torch.long).to(self.device)
+            x_rec_knn = x_rec_proj.detach().reshape(self.batch_size, -1)
+            assigned_labels = self.kmeans.fit_predict(x_rec_knn)
             y = y[:, 0, :].reshape(-1).to(torch.long)
-            adj_rand_index, nmi, f1, p_score = get_scores(y, assigned_labels,
-                                                                      n_clusters=self.n_clusters,
-                                                                      device=self.device)
+            if scorer is not None:
+                # dataset-level scores are computed by the caller from the accumulated assignments,
+                # the k-means of every batch is its own fit so its ids are aligned on the reconstructions
+                scorer.update(y, assigned_labels, features=x_rec_knn)
+                adj_rand_index, nmi, f1, p_score = 0, 0, 0, 0
+            else:
+                adj_rand_index, nmi, f1, p_score = get_scores(y, assigned_labels,
+                                                              n_clusters=self.n_clusters,
+                                                              device=self.device,
+                                                              scorer=self.scorer)
 
         else:
             adj_rand_index, nmi, f1, p_score = 0, 0, 0, 0
@@ -0,0 +1,270 @@
+import numpy as np
+from joblib import Parallel, delayed
+from tslearn.barycenters import dtw_barycenter_averaging
+from tslearn.metrics import dtw
+
+
+def sakoe_chiba_radius(sz, radius=None):
+    # 10% of the window, the usual width of the Sakoe-Chiba band
+    return max(1, int(0.1 * sz)) if radius is None else radius
+
+
+def _chunks(x, n_jobs, chunk_size=1024):
+    # bounds the [chunk, n_clusters, sz, d] lower-bound arrays and gives every worker some chunks
+    return np.array_split(x, max(n_jobs, -(-len(x) // chunk_size)))
+
+
+def keogh_envelope(x, radius):
+    """
+    Upper and lower envelopes of every series under a Sakoe-Chiba band of the given radius.
+
+    :param x: [n, sz, d] series
+    :return: [n, sz, d] upper and lower envelopes
+    """
+    # edge padding repeats the end points, which are already inside the clipped windows
+    padded = np.pad(x, ((0, 0), (radius, radius), (0, 0)), mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * radius + 1, axis=1)
+    return windows.max(axis=-1), windows.min(axis=-1)
+
+
+def lb_kim(x, centroids):
+    """
+    LB_Kim lower bound of DTW: every warping path matches the first and the last points.
+
+    :param x: [n, sz, d] series
+    :param centroids: [k, sz, d] series
+    :return: [n, k] lower bounds
+    """
+    bound = ((x[:, None, 0] - centroids[None, :, 0]) ** 2).sum(-1)
+    if x.shape[1] > 1:
+        bound += ((x[:, None, -1] - centroids[None, :, -1]) ** 2).sum(-1)
+    return np.sqrt(bound)
+
+
+def lb_keogh(x, upper, lower):
+    """
+    LB_Keogh lower bound of DTW under a Sakoe-Chiba band: distance of every point to the envelope of the other series.
+
+    :param x: [n, sz, d] series
+    :param upper: [k, sz, d] upper envelopes
+    :param lower: [k, sz, d] lower envelopes
+    :return: [n, k] lower bounds
+    """
+    above = np.clip(x[:, None] - upper[None], 0, None)
+    below = np.clip(lower[None] - x[:, None], 0, None)
+    return np.sqrt((above ** 2 + below ** 2).sum(axis=(-2, -1)))
+
+
+def _assign_dtw(x, centroids, upper, lower, radius):
+    """
+    Nearest centroid under DTW. Centroids are visited by increasing lower bound and the full DTW
+    is skipped as soon as the bound reaches the best distance found so far.
+
+    :return: [n] labels, [n] distances and the number of full DTW computations
+    """
+    bounds = np.maximum(lb_kim(x, centroids), lb_keogh(x, upper, lower))
+
+    labels = np.zeros(len(x), dtype=np.int64)
+    distances = np.zeros(len(x))
+    n_dtw = 0
+
+    for i in range(len(x)):
+        best = np.inf
+        for k in np.argsort(bounds[i]):
+            if bounds[i, k] >= best:
+                break
+            dist = dtw(x[i], centroids[k], global_constraint="sakoe_chiba", sakoe_chiba_radius=radius)
+            n_dtw += 1
+            if dist < best:
+                best = dist
+                labels[i] = k
+        distances[i] = best
+
+    return labels, distances, n_dtw
+
+
+def _dba(members, centroid, radius, max_iter):
+    if len(members) == 0:
+        return centroid
+    return dtw_barycenter_averaging(members, barycenter_size=len(centroid), init_barycenter=centroid,
+                                    max_iter=max_iter,
+                                    metric_params={"global_constraint": "sakoe_chiba",
+                                                   "sakoe_chiba_radius": radius})
+
+
+class DTWKMeans:
+    """
+    k-means under DTW with DBA barycenters (Petitjean et al., 2011).
+    Assignments are pruned with LB_Kim and LB_Keogh, so most full DTW computations are skipped,
+    and both steps run in parallel with joblib.
+
+    :param n_clusters: number of clusters
+    :param radius: Sakoe-Chiba radius, None for 10% of the window
+    :param max_iter: maximum number of assignment / barycenter iterations
+    :param dba_iter: DBA iterations per barycenter update
+    :param n_jobs: joblib workers
+    :param seed: seed of the initial centroids
+    """
+    def __init__(self, n_clusters, radius=None, max_iter=10, dba_iter=5, n_jobs=1, seed=1234):
+
+        self.n_clusters = n_clusters
+        self.radius = radius
+        self.max_iter = max_iter
+        self.dba_iter = dba_iter
+        self.n_jobs = n_jobs
+        self.seed = seed
+
+        self.cluster_centers_ = None
+        # share of the series-centroid pairs whose full DTW was skipped
+        self.pruned_ratio_ = 0.
+
+    def _assign(self, x, centroids, radius):
+
+        upper, lower = keogh_envelope(centroids, radius)
+        results = Parallel(n_jobs=self.n_jobs)(delayed(_assign_dtw)(chunk, centroids, upper, lower, radius)
+                                               for chunk in _chunks(x, self.n_jobs))
+        labels, _, n_dtw = zip(*results)
+
+        self.pruned_ratio_ = 1 - sum(n_dtw) / (len(x) * len(centroids))
+        return np.concatenate(labels)
+
+    def fit_predict(self, x):
+        """
+        :param x: [n, sz, d] series
+        :return: [n] cluster assignments
+        """
+        x = np.asarray(x, dtype=np.float64)
+        radius = sakoe_chiba_radius(x.shape[1], self.radius)
+
+        rng = np.random.default_rng(self.seed)
+        centroids = x[rng.choice(len(x), self.n_clusters, replace=len(x) < self.n_clusters)]
+        labels = None
+
+        for _ in range(self.max_iter):
+
+            new_labels = self._assign(x, centroids, radius)
+            if labels is not None and np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+
+            centroids = np.stack(Parallel(n_jobs=self.n_jobs)(
+                delayed(_dba)(x[labels == k], centroids[k], radius, self.dba_iter)
+                for k in range(self.n_clusters)))
+
+        self.cluster_centers_ = centroids
+        return labels
+
+
+def _znorm(x):
+    std = x.std(axis=1, keepdims=True)
+    return (x - x.mean(axis=1, keepdims=True)) / np.where(std == 0, 1, std)
+
+
+def _sbd(x, centroids):
+    """
+    Shape-based distance, one minus the maximum normalized cross-correlation over all shifts,
+    with the FFT cross-correlation of every pair at once.
+
+    :param x: [n, sz, d] series
+    :param centroids: [k, sz, d] series
+    :return: [n, k] distances and [n, k] shifts of x reaching them
+    """
+    sz = x.shape[1]
+    fft_len = 1 << (2 * sz - 1).bit_length()
+
+    fft_x = np.fft.rfft(x, fft_len, axis=1)
+    fft_c = np.fft.rfft(centroids, fft_len, axis=1)
+    cc = np.fft.irfft(fft_x[:, None] * np.conj(fft_c[None]), fft_len, axis=2).sum(-1)
+    # shifts -(sz - 1) .. sz - 1
+    cc = np.concatenate([cc[..., fft_len - sz + 1:], cc[..., :sz]], axis=-1)
+
+    norm = np.sqrt((x ** 2).sum(axis=(1, 2)))[:, None] * np.sqrt((centroids ** 2).sum(axis=(1, 2)))[None]
+    ncc = cc / np.where(norm == 0, np.inf, norm)[..., None]
+
+    return 1 - ncc.max(axis=-1), ncc.argmax(axis=-1) - (sz - 1)
+
+
+def _shift(x, shifts):
+    # aligned[t] = x[t + shift], zero outside the series
+    sz = x.shape[1]
+    source = np.arange(sz)[None] + shifts[:, None]
+    valid = (source >= 0) & (source < sz)
+    aligned = np.take_along_axis(x, np.clip(source, 0, sz - 1)[..., None], axis=1)
+    return aligned * valid[..., None]
+
+
+def _shape_extraction(members, centroid):
+    """Shape extraction of k-Shape: leading eigenvector of the centered scatter of the aligned members."""
+    if len(members) == 0:
+        return centroid
+
+    if centroid.any():
+        _, shifts = _sbd(members, centroid[None])
+        members = _znorm(_shift(members, shifts[:, 0]))
+
+    sz = members.shape[1]
+    centering = np.eye(sz) - np.ones((sz, sz)) / sz
+    new_centroid = np.empty_like(centroid)
+
+    for d in range(members.shape[2]):
+        scatter = members[:, :, d].T @ members[:, :, d]
+        _, vectors = np.linalg.eigh(centering @ scatter @ centering)
+        shape = vectors[:, -1]
+        # the eigenvector sign is arbitrary, keep the one closer to the members
+        if ((members[:, :, d] - shape) ** 2).sum() > ((members[:, :, d] + shape) ** 2).sum():
+            shape = -shape
+        new_centroid[:, d] = shape
+
+    return _znorm(new_centroid[None])[0]
+
+
+def _sbd_distances(x, centroids):
+    return _sbd(x, centroids)[0]
+
+
+class KShape:
+    """
+    k-Shape (Paparrizos and Gravano, 2015) on z-normalized series.
+    The shape-based distance has no lower-bound cascade, every series-centroid pair is instead
+    scored at once by FFT cross-correlation; assignments and shape extraction run in parallel with joblib.
+
+    :param n_clusters: number of clusters
+    :param max_iter: maximum number of assignment / refinement iterations
+    :param n_jobs: joblib workers
+    :param seed: seed of the initial random assignment
+    """
+    def __init__(self, n_clusters, max_iter=100, n_jobs=1, seed=1234):
+
+        self.n_clusters = n_clusters
+        self.max_iter = max_iter
+        self.n_jobs = n_jobs
+        self.seed = seed
+
+        self.cluster_centers_ = None
+
+    def fit_predict(self, x):
+        """
+        :param x: [n, sz, d] series
+        :return: [n] cluster assignments
+        """
+        x = _znorm(np.asarray(x, dtype=np.float64))
+
+        rng = np.random.default_rng(self.seed)
+        labels = rng.integers(self.n_clusters, size=len(x))
+        centroids = np.zeros((self.n_clusters, x.shape[1], x.shape[2]))
+
+        for _ in range(self.max_iter):
+
+            centroids = np.stack(Parallel(n_jobs=self.n_jobs)(
+                delayed(_shape_extraction)(x[labels == k], centroids[k]) for k in range(self.n_clusters)))
+
+            distances = np.concatenate(Parallel(n_jobs=self.n_jobs)(
+                delayed(_sbd_distances)(chunk, centroids) for chunk in _chunks(x, self.n_jobs)))
+
+            new_labels = distances.argmin(axis=-1)
+            if np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+
+        self.cluster_centers_ = centroids
+        return labels
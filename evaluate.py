@@ -17,6 +17,7 @@ from psycology_data_loader import PatientDataLoader
 from seed_manager import set_seed
 from som_vae import SOMVAE
 from synthetic_data import SyntheticDataLoader
+from util_scores import ClusteringScorer
 
 
 set_seed(9800)
@@ -251,7 +252,7 @@ class DimRec:
                                 dim_rec_model.train()
                                 for x, y in self.data_loader.train_loader:
                                     with torch.no_grad():
-                                        _, _, _, _, _, x_rec_cluster = clustering_model(x.to(self.device), y.to(self.device))
+                                        _, _, _, _, _, x_rec_cluster = clustering_model(x.to(self.device))
 
                                     optimizer.zero_grad()
                                     x_rec_cluster = x_rec_cluster.reshape(self.batch_size, -1)
@@ -266,7 +267,7 @@ class DimRec:
                                 dim_rec_model.eval()
                                 for x, y in self.data_loader.test_loader:
                                     with torch.no_grad():
-                                        _, _, _, _, _, x_rec_cluster = clustering_model(x.to(self.device), y.to(self.device))
+                                        _, _, _, _, _, x_rec_cluster = clustering_model(x.to(self.device))
 
                                     x_rec_cluster = x_rec_cluster.reshape(self.batch_size, -1)
                                     x_dim_rec = dim_rec_model(x_rec_cluster)
@@ -303,6 +304,8 @@ class DimRec:
 
         list_2d = []
         list_y = []
+        # one contingency table over every hold-out batch
+        scorer = ClusteringScorer(n_clusters=self.n_clusters)
 
         for knn in knn_list:
             for d_model in d_model_list:
@@ -349,7 +352,8 @@ class DimRec:
 
                                 with torch.no_grad():
                                     _, _, _, _, _, x_rec_cluster = clustering_model(x.to(self.device),
-                                                                                    y.to(self.device))
+                                                                                    y.to(self.device),
+                                                                                    scorer=scorer)
                                     x_rec_cluster = x_rec_cluster.reshape(self.batch_size, -1)
                                     x_dim_rec = self.best_dim_rec_model.encoder(x_rec_cluster)
                                     list_2d.append(x_dim_rec)
@@ -358,6 +362,9 @@ class DimRec:
                         except RuntimeError:
                             pass
 
+        adj, nmi, f1, p_score = [score.item() for score in scorer.compute()]
+        print("adj rand index {:.3f}, nmi {:.3f}, f1 {:.3f}, p_score {:.3f}".format(adj, nmi, f1, p_score))
+
         x_reconstructs = torch.cat(list_2d)
         label = torch.cat(list_y).to(torch.int)
 
@@ -2,6 +2,10 @@ import random
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+from forecasting_models.MultiScaleConv import MultiScaleConv1d
+from modules.mask_cache import causal_mask_cache
 
 
 class ACAT(nn.Module):
@@ -18,19 +22,49 @@ class ACAT(nn.Module):
 
         self.d_k = d_k
         self.filter_length = [3, 7, 9]
-        self.conv_list_q = nn.ModuleList(
-            [nn.Conv1d(in_channels=d_k*h, out_channels=d_k*h,
-                       kernel_size=f,
-                       padding=int(f/2),
-                       device=device) for f in self.filter_length])
-        self.conv_list_k = nn.ModuleList(
-            [nn.Conv1d(in_channels=d_k*h, out_channels=d_k*h,
-                       kernel_size=f,
-                       padding=int(f/2),
-                       device=device) for f in self.filter_length])
+        conv_list_q = [nn.Conv1d(in_channels=d_k*h, out_channels=d_k*h,
+                                 kernel_size=f,
+                                 padding=int(f/2),
+                                 device=device) for f in self.filter_length]
+        conv_list_k = [nn.Conv1d(in_channels=d_k*h, out_channels=d_k*h,
+                                 kernel_size=f,
+                                 padding=int(f/2),
+                                 device=device) for f in self.filter_length]
+        # all kernel sizes for Q and K in one stacked convolution
+        self.conv_qk = MultiScaleConv1d(conv_list_q, conv_list_k)
         self.norm = nn.BatchNorm1d(h * d_k).to(device)
         self.activation = nn.ELU()
 
+    def _shared_norm(self, x):
+        """
+        Applies self.norm to every kernel scale of x [b, n_scales * h * d_k, l] separately,
+        exactly as if the batch norm was called once per scale.
+        """
+        n_scales = len(self.filter_length)
+        norm = self.norm
+        weight = norm.weight.repeat(n_scales) if norm.weight is not None else None
+        bias = norm.bias.repeat(n_scales) if norm.bias is not None else None
+
+        if not norm.training and norm.track_running_stats:
+            return F.batch_norm(x, norm.running_mean.repeat(n_scales), norm.running_var.repeat(n_scales),
+                                weight, bias, False, 0.0, norm.eps)
+
+        out = F.batch_norm(x, None, None, weight, bias, True, 0.0, norm.eps)
+
+        if norm.track_running_stats and norm.momentum is not None:
+            with torch.no_grad():
+                # fold the per-scale statistics into the running statistics in call order
+                m = norm.momentum
+                n = x.shape[0] * x.shape[2]
+                mean = x.mean(dim=(0, 2)).reshape(n_scales, -1)
+                var = x.var(dim=(0, 2), unbiased=n > 1).reshape(n_scales, -1)
+                decay = m * (1 - m) ** torch.arange(n_scales - 1, -1, -1, device=x.device, dtype=x.dtype)
+                norm.running_mean.mul_((1 - m) ** n_scales).add_((decay.unsqueeze(-1) * mean).sum(0))
+                norm.running_var.mul_((1 - m) ** n_scales).add_((decay.unsqueeze(-1) * var).sum(0))
+                norm.num_batches_tracked.add_(n_scales)
+
+        return out
+
     def forward(self, Q, K, V, mask=False):
 
         b, h, l, d_k = Q.shape
@@ -38,26 +72,22 @@ class ACAT(nn.Module):
 
         len_n_k = len(self.filter_length)
 
-        Q_l = [self.activation(self.norm(self.conv_list_q[i](Q.reshape(b, h*d_k, l))))[:, :, :l]
-               for i in range(len(self.filter_length))]
-        K_l = [self.activation(self.norm(self.conv_list_k[i](K.reshape(b, h * d_k, l_k))))[:, :, :l_k]
-               for i in range(len(self.filter_length))]
-        Q_p = torch.cat(Q_l, dim=0).reshape(b, h, len_n_k, l, d_k)
-        K_tmp = torch.cat(K_l, dim=0).reshape(b, h, len_n_k, l_k, d_k)
+        Q_l, K_l = self.conv_qk(Q.reshape(b, h*d_k, l), K.reshape(b, h * d_k, l_k))
+        Q_l = self.activation(self._shared_norm(Q_l))
+        K_l = self.activation(self._shared_norm(K_l))
 
-        m_f = max(self.filter_length)
+        # scale-major layout, as if the per-scale outputs were concatenated along the batch
+        Q_p = Q_l.reshape(b, len_n_k, h*d_k, l).transpose(0, 1).reshape(b, h, len_n_k, l, d_k)
+        K_tmp = K_l.reshape(b, len_n_k, h*d_k, l_k).transpose(0, 1).reshape(b, h, len_n_k, l_k, d_k)
 
         scores = torch.einsum('bhpqd,bhpkd->bhpqk', Q_p, K_tmp) / np.sqrt(self.d_k)
 
         if mask:
 
-            mask = torch.tril(torch.ones(l, l_k)).to(torch.bool)
-            mask = mask.unsqueeze(0).repeat(b, 1, 1).unsqueeze(1).\
-                repeat(1, h, 1, 1).unsqueeze(2).repeat(1, 1, len_n_k, 1, 1).to(self.device)
-            scores.masked_fill_(mask, -1e10)
+            scores.masked_fill_(causal_mask_cache.get(l, l_k, device=scores.device), -1e10)
 
         attn = torch.softmax(scores, -1)
         attn, _ = torch.max(attn, dim=2)
 
         context = torch.einsum('bhqk,bhkd->bhqd', attn, V)
-        return context, attn
\ No newline at end of file
+        return context, attn
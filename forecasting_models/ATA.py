@@ -3,6 +3,8 @@ import torch.nn as nn
 import numpy as np
 import random
 
+from forecasting_models.MultiScaleConv import MultiScaleConv1d
+from modules.mask_cache import causal_mask_cache
 from seed_manager import set_seed
 
 
@@ -17,19 +19,16 @@ class ATA(nn.Module):
         self.filter_length = [1, 3, 7, 9]
         self.device = device
 
-        self.conv_list_k = nn.ModuleList([
-            nn.Sequential(nn.Conv1d(
-                in_channels=d_k*h, out_channels=d_k*h, kernel_size=f, padding=int((f-1)/2)),
-                          nn.BatchNorm1d(d_k*h),
-                          nn.ReLU()).to(device)
-            for f in self.filter_length])
+        conv_list_k = [nn.Conv1d(in_channels=d_k*h, out_channels=d_k*h, kernel_size=f, padding=int((f-1)/2))
+                       for f in self.filter_length]
+        conv_list_q = [nn.Conv1d(in_channels=d_k*h, out_channels=d_k*h, kernel_size=f, padding=int((f-1)/2))
+                       for f in self.filter_length]
 
-        self.conv_list_q = nn.ModuleList([
-            nn.Sequential(
-                nn.Conv1d(in_channels=d_k*h, out_channels=d_k*h, kernel_size=f, padding=int((f-1)/2)),
-                          nn.BatchNorm1d(d_k*h),
-                          nn.ReLU()).to(device)
-            for f in self.filter_length])
+        # all kernel sizes for Q and K in one stacked convolution
+        self.conv_qk = MultiScaleConv1d(conv_list_q, conv_list_k).to(device)
+        # one batch norm per (kernel size, channel), same as a batch norm per kernel size
+        self.norm_q = nn.BatchNorm1d(d_k*h*len(self.filter_length)).to(device)
+        self.norm_k = nn.BatchNorm1d(d_k*h*len(self.filter_length)).to(device)
 
         self.proj_back_q = nn.Linear(d_k*len(self.filter_length), self.d_k)
         self.proj_back_k = nn.Linear(d_k*len(self.filter_length), self.d_k)
@@ -41,32 +40,28 @@ class ATA(nn.Module):
         b, h, l, d_k = Q.shape
 
         l_k = K.shape[2]
-        Q_l = []
-        K_l = []
+        len_n_k = len(self.filter_length)
 
         Q = Q.reshape(b, -1, l)
         K = K.reshape(b, -1, l_k)
 
-        [Q_l.append(self.conv_list_q[i](Q)) for i in range(len(self.filter_length))]
-        [K_l.append(self.conv_list_k[i](K)) for i in range(len(self.filter_length))]
+        Q_l, K_l = self.conv_qk(Q, K)
+        Q_l = torch.relu(self.norm_q(Q_l))
+        K_l = torch.relu(self.norm_k(K_l))
 
-        Q_p = torch.cat(Q_l, dim=0).reshape(b, h, l * len(self.filter_length), -1)
-        K_p = torch.cat(K_l, dim=0).reshape(b, h, l_k * len(self.filter_length), -1)
-
-        Q_proj = Q_p.reshape(b, h, l, -1)
+        # scale-major layout, as if the per-scale outputs were concatenated along the batch
+        Q_proj = Q_l.reshape(b, len_n_k, -1, l).transpose(0, 1).reshape(b, h, l, -1)
         Q, _ = torch.topk(Q_proj, dim=-1, k=1)
 
-        K_proj = K_p.reshape(b, h, l_k, -1)
+        K_proj = K_l.reshape(b, len_n_k, -1, l_k).transpose(0, 1).reshape(b, h, l_k, -1)
         K, _ = torch.topk(K_proj, dim=-1, k=1)
 
         scores = torch.einsum('bhqd,bhkd->bhqk', Q, K) / np.sqrt(self.d_k)
 
         if mask:
 
-            mask = torch.tril(torch.ones(l, l_k)).to(torch.bool)
-            mask = mask.unsqueeze(0).repeat(b, 1, 1).unsqueeze(1).repeat(1, h, 1, 1).to(self.device)
-            scores.masked_fill_(mask, -1e10)
+            scores.masked_fill_(causal_mask_cache.get(l, l_k, device=scores.device), -1e10)
 
         attn = torch.softmax(scores, -1)
         context = torch.einsum('bhqk,bhkd->bhqd', attn, V)
-        return context, attn
\ No newline at end of file
+        return context, attn
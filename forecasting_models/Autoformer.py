@@ -27,28 +27,30 @@ class AutoCorrelation(nn.Module):
         self.output_attention = output_attention
         self.dropout = nn.Dropout(attention_dropout)
 
+    @staticmethod
+    def _roll_index(delay, length):
+        """
+        Indices of every delayed copy of the series, [..., top_k, length], so that
+        values[..., index] equals torch.roll(values, -delay, -1) for each delay.
+        """
+        return (torch.arange(length, device=delay.device) + delay.unsqueeze(-1)) % length
+
     def time_delay_agg_training(self, values, corr):
         """
         SpeedUp version of Autocorrelation (a batch-normalization style design)
         This is for the training phase.
         """
-        head = values.shape[1]
-        channel = values.shape[2]
         length = values.shape[3]
         # find top k
         top_k = int(self.factor * math.log(length))
         mean_value = torch.mean(torch.mean(corr, dim=1), dim=1)
         index = torch.topk(torch.mean(mean_value, dim=0), top_k, dim=-1)[1]
-        weights = torch.stack([mean_value[:, index[i]] for i in range(top_k)], dim=-1)
+        weights = mean_value[:, index]
         # update corr
         tmp_corr = torch.softmax(weights, dim=-1)
-        # aggregation
-        tmp_values = values
-        delays_agg = torch.zeros_like(values).float()
-        for i in range(top_k):
-            pattern = torch.roll(tmp_values, -int(index[i]), -1)
-            delays_agg = delays_agg + pattern * \
-                         (tmp_corr[:, i].unsqueeze(1).unsqueeze(1).unsqueeze(1).repeat(1, head, channel, length))
+        # aggregation, the delays are shared by the batch: [B, H, C, top_k, L]
+        patterns = values[..., self._roll_index(index, length)]
+        delays_agg = torch.einsum('bhckl,bk->bhcl', patterns, tmp_corr.to(values.dtype))
         return delays_agg
 
     def time_delay_agg_inference(self, values, corr):
@@ -60,46 +62,32 @@ class AutoCorrelation(nn.Module):
         head = values.shape[1]
         channel = values.shape[2]
         length = values.shape[3]
-        # index init
-        init_index = torch.arange(length).unsqueeze(0).unsqueeze(0).unsqueeze(0).repeat(batch, head, channel, 1).cuda()
         # find top k
         top_k = int(self.factor * math.log(length))
         mean_value = torch.mean(torch.mean(corr, dim=1), dim=1)
         weights, delay = torch.topk(mean_value, top_k, dim=-1)
         # update corr
         tmp_corr = torch.softmax(weights, dim=-1)
-        # aggregation
-        tmp_values = values.repeat(1, 1, 1, 2)
-        delays_agg = torch.zeros_like(values).float()
-        for i in range(top_k):
-            tmp_delay = init_index + delay[:, i].unsqueeze(1).unsqueeze(1).unsqueeze(1).repeat(1, head, channel, length)
-            pattern = torch.gather(tmp_values, dim=-1, index=tmp_delay)
-            delays_agg = delays_agg + pattern * \
-                         (tmp_corr[:, i].unsqueeze(1).unsqueeze(1).unsqueeze(1).repeat(1, head, channel, length))
+        # aggregation, one set of delays per sample: [B, H, C, top_k, L]
+        index = self._roll_index(delay, length).unsqueeze(1).unsqueeze(1).expand(batch, head, channel, top_k, length)
+        patterns = torch.gather(values.unsqueeze(-2).expand(-1, -1, -1, top_k, -1), dim=-1, index=index)
+        delays_agg = torch.einsum('bhckl,bk->bhcl', patterns, tmp_corr.to(values.dtype))
         return delays_agg
 
     def time_delay_agg_full(self, values, corr):
         """
         Standard version of Autocorrelation
         """
-        batch = values.shape[0]
-        head = values.shape[1]
-        channel = values.shape[2]
         length = values.shape[3]
-        # index init
-        init_index = torch.arange(length).unsqueeze(0).unsqueeze(0).unsqueeze(0).repeat(batch, head, channel, 1).cuda()
         # find top k
         top_k = int(self.factor * math.log(length))
         weights, delay = torch.topk(corr, top_k, dim=-1)
         # update corr
         tmp_corr = torch.softmax(weights, dim=-1)
-        # aggregation
-        tmp_values = values.repeat(1, 1, 1, 2)
-        delays_agg = torch.zeros_like(values).float()
-        for i in range(top_k):
-            tmp_delay = init_index + delay[..., i].unsqueeze(-1)
-            pattern = torch.gather(tmp_values, dim=-1, index=tmp_delay)
-            delays_agg = delays_agg + pattern * (tmp_corr[..., i].unsqueeze(-1))
+        # aggregation, one set of delays per sample, head and channel: [B, H, C, top_k, L]
+        index = self._roll_index(delay, length)
+        patterns = torch.gather(values.unsqueeze(-2).expand(-1, -1, -1, top_k, -1), dim=-1, index=index)
+        delays_agg = (patterns * tmp_corr.to(values.dtype).unsqueeze(-1)).sum(dim=-2)
         return delays_agg
 
     def forward(self, queries, keys, values, attn_mask=None):
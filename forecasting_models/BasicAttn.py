@@ -1,30 +1,86 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
+from modules.mask_cache import causal_mask_cache
 
-class BasicAttn(nn.Module):
 
-    def __init__(self, d_k, device):
+def check_attn_version(backend, attn_version):
+    """
+    attn_version 1 is the legacy contraction einsum('bhqk,bhvd->bhqd'), which sums the keys and the values
+    separately so every query gets the sum of V, 2 is the attention-weighted sum attn @ V.
+    The sdpa backend only computes version 2.
+    """
+    if attn_version not in (1, 2):
+        raise ValueError(f"attn_version must be 1 or 2, got `{attn_version}`")
+    if backend == "sdpa" and attn_version == 1:
+        raise ValueError("the sdpa backend computes attn @ V (attn_version 2), "
+                         "it cannot run models of the legacy attn_version 1")
 
-        super(BasicAttn, self).__init__()
 
-        self.d_k = d_k
-        self.device = device
+def register_attn_version(module, backend, attn_version):
+    """
+    Stores attn_version in the state dict of an attention kernel, checkpoints without it are version 1
+    and load with the legacy contraction whatever version the kernel was built with.
+    """
+    check_attn_version(backend, attn_version)
+    module.attn_version = attn_version
+    module.register_buffer("_attn_version", torch.tensor(attn_version))
 
-    def forward(self, Q, K, V, mask=False):
+    def load_attn_version(state_dict, prefix, *args):
+        key = prefix + "_attn_version"
+        if key not in state_dict:
+            state_dict[key] = torch.tensor(1)
+        check_attn_version(backend, int(state_dict[key]))
+        module.attn_version = int(state_dict[key])
+
+    module._register_load_state_dict_pre_hook(load_attn_version)
 
-        b, h, l, _ = Q.shape
-        _, _, l_k, _ = K.shape
 
-        scores = torch.einsum('bhqd,bhkd->bhqk', Q, K) / np.sqrt(self.d_k)
+def dot_product_attention(Q, K, V, d_k, mask, backend, attn_version):
+    """
+    Scaled dot-product attention of the basic and convolutional kernels, with the einsum or the sdpa backend.
+    mask hides the lower triangle of the scores, diagonal included, see MaskCache.
 
-        if mask:
+    :param Q: [b, h, l, d_k]
+    :param K: [b, h, l_k, d_k]
+    :param V: [b, h, l_k, d_k]
+    :return: [b, h, l, d_k] context and the [b, h, l, l_k] attention weights (None with sdpa)
+    """
+    l, l_k = Q.shape[2], K.shape[2]
 
-            mask = torch.tril(torch.ones(l, l_k)).to(torch.bool)
-            mask = mask.unsqueeze(0).repeat(b, 1, 1).unsqueeze(1).repeat(1, h, 1, 1).to(self.device)
-            scores.masked_fill_(mask, -1e10)
+    if backend == "sdpa":
+        # additive mask, a boolean one would turn fully masked rows into NaN, see MaskCache.get_additive
+        attn_mask = causal_mask_cache.get_additive(l, l_k, device=Q.device, dtype=Q.dtype) if mask else None
+        context = F.scaled_dot_product_attention(Q, K, V, attn_mask=attn_mask, scale=1 / np.sqrt(d_k))
+        return context, None
 
-        attn = torch.softmax(scores, -1)
+    scores = torch.einsum('bhqd,bhkd->bhqk', Q, K) / np.sqrt(d_k)
+
+    if mask:
+
+        scores.masked_fill_(causal_mask_cache.get(l, l_k, device=scores.device), -1e10)
+
+    attn = torch.softmax(scores, -1)
+    if attn_version == 1:
         context = torch.einsum('bhqk,bhvd->bhqd', attn, V)
-        return context, attn
\ No newline at end of file
+    else:
+        context = attn @ V
+    return context, attn
+
+
+class BasicAttn(nn.Module):
+
+    def __init__(self, d_k, device, backend="einsum", attn_version=1):
+
+        super(BasicAttn, self).__init__()
+
+        self.d_k = d_k
+        self.device = device
+        self.backend = backend
+        register_attn_version(self, backend, attn_version)
+
+    def forward(self, Q, K, V, mask=False):
+
+        return dot_product_attention(Q, K, V, self.d_k, mask, self.backend, self.attn_version)
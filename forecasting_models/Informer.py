@@ -7,7 +7,8 @@ from seed_manager import set_seed
 
 
 class ProbAttention(nn.Module):
-    def __init__(self, mask_flag, seed, factor=1, scale=None, attention_dropout=0.1, output_attention=False):
+    def __init__(self, mask_flag, seed, factor=1, scale=None, attention_dropout=0.1, output_attention=False,
+                 dense_attention=False):
         super(ProbAttention, self).__init__()
 
         set_seed(seed)
@@ -16,6 +17,8 @@ class ProbAttention(nn.Module):
         self.scale = scale
         self.mask_flag = mask_flag
         self.output_attention = output_attention
+        # when False the returned attention only holds the rows of the top-u queries
+        self.dense_attention = dense_attention
         self.dropout = nn.Dropout(attention_dropout)
 
     def _prob_QK(self, Q, K, sample_k, n_top):  # n_top: c*ln(L_q)
@@ -23,13 +26,10 @@ class ProbAttention(nn.Module):
         B, H, L_K, E = K.shape
         _, _, L_Q, _ = Q.shape
 
-        # calculate the sampled Q_K
-        K_expand = K.unsqueeze(-3).expand(B, H, L_Q, L_K, E)
-        index_sample = torch.randint(L_K, (L_Q, sample_k))  # real U = U_part(factor*ln(L_k))*L_q
-        K_sample = K_expand[:, :, torch.arange(L_Q).unsqueeze(1), index_sample, :]
-        Q = Q.reshape(B, H, L_Q, -1)
-        K_sample = K_sample.reshape(B, H, -1, E)
-        Q_K_sample = torch.einsum('bhqd, bhkd -> bhqk', Q, K_sample)
+        # calculate the sampled Q_K, each query only sees its own sample_k keys
+        index_sample = torch.randint(L_K, (L_Q, sample_k), device=K.device)  # real U = U_part(factor*ln(L_k))*L_q
+        K_sample = K[:, :, index_sample, :]  # [B, H, L_Q, sample_k, E]
+        Q_K_sample = torch.einsum('bhqd, bhqsd -> bhqs', Q, K_sample)
 
         # find the Top_k query with sparisty measurement
         M = Q_K_sample.max(-1)[0] - torch.div(Q_K_sample.sum(-1), L_K)
@@ -62,10 +62,14 @@ class ProbAttention(nn.Module):
         context_in[torch.arange(B)[:, None, None],
         torch.arange(H)[None, :, None],
         index, :] = torch.matmul(attn, V).type_as(context_in)
-        if self.output_attention:
-            attns = (torch.ones([B, H, L_V, L_V]) / L_V).type_as(attn).to(attn.device)
+        if self.output_attention and self.dense_attention:
+            attns = torch.full([B, H, L_V, L_V], 1 / L_V, dtype=attn.dtype, device=attn.device)
             attns[torch.arange(B)[:, None, None], torch.arange(H)[None, :, None], index, :] = attn
             return (context_in, attns)
+        elif self.output_attention:
+            # [B, H, u, L_V] rows of the top-u queries and their positions,
+            # every other query attends uniformly (1 / L_V) to all keys
+            return (context_in, (attn, index))
         else:
             return (context_in, None)
 
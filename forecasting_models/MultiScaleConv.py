@@ -0,0 +1,60 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class MultiScaleConv1d(nn.Module):
+    """
+    Packs per-scale query and key Conv1d layers into a single stacked convolution.
+    Every kernel is zero-padded to the widest kernel so each scale keeps its "same" padding,
+    queries and keys are convolved in one grouped call whenever their shapes match.
+    A fixed tap mask keeps the padded taps at zero, so the narrow scales stay narrow while training.
+
+    :param convs_q: Conv1d layers applied to the queries, one per kernel size
+    :param convs_k: Conv1d layers applied to the keys, one per kernel size
+    """
+    def __init__(self, convs_q, convs_k):
+
+        super(MultiScaleConv1d, self).__init__()
+
+        convs = list(convs_q) + list(convs_k)
+        kernel_sizes = [conv.kernel_size[0] for conv in convs]
+        assert all(f % 2 == 1 for f in kernel_sizes), "kernel sizes must be odd"
+
+        m_f = max(kernel_sizes)
+        self.padding = m_f // 2
+        self.n_scales = len(convs_q)
+        self.out_channels = convs_q[0].out_channels * self.n_scales
+
+        # [2 * n_scales * out_channels, in_channels, m_f], query scales first, then key scales
+        weight = torch.cat([F.pad(conv.weight.detach(), (self.padding - f // 2, self.padding - f // 2))
+                            for conv, f in zip(convs, kernel_sizes)], dim=0)
+        self.weight = nn.Parameter(weight.clone())
+        # 1 on the taps of every kernel, 0 on its padding, not saved so older checkpoints still load
+        tap_mask = torch.cat([F.pad(torch.ones_like(conv.weight, dtype=weight.dtype),
+                                    (self.padding - f // 2, self.padding - f // 2))
+                              for conv, f in zip(convs, kernel_sizes)], dim=0)
+        self.register_buffer("tap_mask", tap_mask, persistent=False)
+
+        if convs[0].bias is not None:
+            self.bias = nn.Parameter(torch.cat([conv.bias.detach() for conv in convs], dim=0).clone())
+        else:
+            self.register_parameter("bias", None)
+
+    def forward(self, Q, K):
+        """
+        :param Q: [batch, in_channels, l]
+        :param K: [batch, in_channels, l_k]
+        :return: [batch, n_scales * out_channels, l], [batch, n_scales * out_channels, l_k]
+        """
+        weight = self.weight * self.tap_mask
+
+        if Q.shape == K.shape:
+            out = F.conv1d(torch.cat([Q, K], dim=1), weight, self.bias,
+                           padding=self.padding, groups=2)
+            return torch.split(out, self.out_channels, dim=1)
+
+        weight_q, weight_k = torch.split(weight, self.out_channels, dim=0)
+        bias_q, bias_k = torch.split(self.bias, self.out_channels, dim=0) if self.bias is not None else (None, None)
+        return (F.conv1d(Q, weight_q, bias_q, padding=self.padding),
+                F.conv1d(K, weight_k, bias_k, padding=self.padding))
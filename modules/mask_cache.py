@@ -0,0 +1,63 @@
+from collections import OrderedDict
+
+import torch
+
+
+class MaskCache:
+    """
+    LRU cache of the [l, l_k] lower-triangular attention masks used by the attention kernels.
+    Masks are keyed by (l, l_k, device, dtype) and returned unexpanded, callers rely on
+    broadcasting against [b, h, ..., l, l_k] scores instead of repeating the mask.
+
+    :param maxsize: number of masks kept before the least recently used one is evicted
+    """
+    def __init__(self, maxsize=32):
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+
+    def _lookup(self, key, build):
+
+        mask = self._masks.get(key)
+
+        if mask is not None:
+            self.hits += 1
+            self._masks.move_to_end(key)
+            return mask
+
+        self.misses += 1
+        mask = build()
+        self._masks[key] = mask
+        if len(self._masks) > self.maxsize:
+            self._masks.popitem(last=False)
+        return mask
+
+    def get(self, l, l_k, device, dtype=torch.bool):
+
+        key = (l, l_k, torch.device(device), dtype)
+        return self._lookup(key, lambda: torch.tril(torch.ones(l, l_k, device=device)).to(dtype))
+
+    def get_additive(self, l, l_k, device, dtype=torch.float32, fill_value=-1e10):
+        """
+        Additive form of the same mask for F.scaled_dot_product_attention: fill_value where the einsum
+        kernels mask_fill the scores (the lower triangle, diagonal included), 0 elsewhere.
+        A boolean attn_mask cannot be used, rows where every key is masked would turn into NaN
+        instead of the uniform weights of the einsum kernels.
+        """
+        key = ("additive", l, l_k, torch.device(device), dtype, fill_value)
+        return self._lookup(key, lambda: torch.zeros(l, l_k, device=device, dtype=dtype).masked_fill_(
+            self.get(l, l_k, device=device), fill_value))
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._masks), "maxsize": self.maxsize}
+
+    def clear(self):
+        self._masks.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+causal_mask_cache = MaskCache()
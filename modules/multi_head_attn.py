@@ -16,9 +16,59 @@ np.random.seed(1234)
 random.seed(1234)
 
 
+def _call_masked(attention, q_s, k_s, v_s, mask):
+    return attention(Q=q_s, K=k_s, V=v_s, mask=mask)
+
+
+def _call_unmasked(attention, q_s, k_s, v_s, mask):
+    return attention(q_s, k_s, v_s)
+
+
+def _call_autoformer(attention, q_s, k_s, v_s, mask):
+    # AutoCorrelation expects [batch, length, heads, d_k]
+    return attention(q_s.transpose(1, 2), k_s.transpose(1, 2), v_s.transpose(1, 2))
+
+
+# attn_type -> (builder(d_k, n_heads, seed, device, backend, attn_version),
+#               call(attention, q_s, k_s, v_s, mask))
+ATTENTION_REGISTRY = {
+    # ATA forecasting model
+    "ATA": (lambda d_k, h, seed, device, backend, version: ATA(d_k=d_k, h=h, seed=seed, device=device),
+            _call_masked),
+    "ACAT": (lambda d_k, h, seed, device, backend, version: ACAT(d_k=d_k, h=h, seed=seed, device=device),
+             _call_masked),
+    # Autoformer forecasting model
+    "autoformer": (lambda d_k, h, seed, device, backend, version: AutoCorrelation(seed=seed),
+                   _call_autoformer),
+    # CNN-trans forecasting model
+    "conv_attn": (lambda d_k, h, seed, device, backend, version: ConvAttn(d_k=d_k, seed=seed, kernel=9, h=h,
+                                                                          backend=backend, attn_version=version),
+                  _call_unmasked),
+    # Informer forecasting model
+    "informer": (lambda d_k, h, seed, device, backend, version: ProbAttention(mask_flag=False, seed=seed),
+                 _call_unmasked),
+    "basic": (lambda d_k, h, seed, device, backend, version: BasicAttn(d_k=d_k, device=device, backend=backend,
+                                                                       attn_version=version),
+              _call_masked),
+}
+
+
+def build_attention(attn_type, d_k, n_heads, seed, device, backend="einsum", attn_version=1):
+    """
+    Instantiate the attention kernel registered under attn_type, unknown types fall back to basic attention.
+    backend is either "einsum" or "sdpa" (torch.nn.functional.scaled_dot_product_attention) and attn_version
+    1 (legacy contraction) or 2 (attn @ V), see check_attn_version; both only affect the kernels computing
+    plain dot-product attention (basic, conv_attn), and sdpa requires attn_version 2.
+
+    :return: (attention module, call function)
+    """
+    builder, call = ATTENTION_REGISTRY.get(attn_type, ATTENTION_REGISTRY["basic"])
+    return builder(d_k, n_heads, seed, device, backend, attn_version), call
+
+
 class MultiHeadAttention(nn.Module):
 
-    def __init__(self, d_model, n_heads, attn_type, seed, device):
+    def __init__(self, d_model, n_heads, attn_type, seed, device, attn_backend="einsum", attn_version=1):
 
         super(MultiHeadAttention, self).__init__()
 
@@ -42,6 +92,11 @@ class MultiHeadAttention(nn.Module):
         self.attn_type = attn_type
         self.seed = seed
 
+        # the kernel is built once so its weights train, follow .to(device) and land in the state dict
+        self.attention, self._call_attention = build_attention(attn_type, d_k, n_heads, seed, device,
+                                                                       backend=attn_backend,
+                                                                       attn_version=attn_version)
+
     def forward(self, Q, K, V, mask=False):
 
         batch_size = Q.shape[0]
@@ -50,37 +105,8 @@ class MultiHeadAttention(nn.Module):
         k_s = self.WK(K).reshape(batch_size, self.n_heads, -1, self.d_k)
         v_s = self.WV(V).reshape(batch_size, self.n_heads, -1, self.d_k)
 
-        # ATA forecasting model
-
-        if self.attn_type == "ATA":
-            context, attn = ATA(d_k=self.d_k, h=self.n_heads, seed=self.seed, device=self.device)(
-            Q=q_s, K=k_s, V=v_s, mask=mask)
-
-        elif self.attn_type == "ACAT":
-            context, attn = ACAT(d_k=self.d_k, h=self.n_heads, seed=self.seed, device=self.device)(
-            Q=q_s, K=k_s, V=v_s, mask=mask)
-
-        # Autoformer forecasting model
-
-        elif self.attn_type == "autoformer":
-            context, attn = AutoCorrelation(seed=self.seed)(q_s.transpose(1, 2),
-                                                            k_s.transpose(1, 2),
-                                                            v_s.transpose(1, 2))
-
-        # CNN-trans forecasting model
-
-        elif self.attn_type == "conv_attn":
-            context, attn = ConvAttn(d_k=self.d_k, seed=self.seed, kernel=9, h=self.n_heads)(
-            Q=q_s, K=k_s, V=v_s)
-
-        # Informer forecasting model
-
-        elif self.attn_type == "informer":
-            context, attn = ProbAttention(mask_flag=False, seed=self.seed)(q_s, k_s, v_s)
-
-        else:
-            context, attn = BasicAttn(d_k=self.d_k, device=self.device)(Q=q_s, K=k_s, V=v_s, mask=mask)
+        context, attn = self._call_attention(self.attention, q_s, k_s, v_s, mask)
 
         context = context.transpose(1, 2).contiguous().view(batch_size, -1, self.n_heads * self.d_v)
         outputs = self.fc(context)
-        return outputs
\ No newline at end of file
+        return outputs
@@ -1,5 +1,9 @@
+import copy
+from contextlib import contextmanager
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from modules.multi_head_attn import MultiHeadAttention
 import random
 import numpy as np
@@ -10,21 +14,36 @@ from seed_manager import set_seed
 class PositionalEncoding(nn.Module):
     def __init__(self, d_model, device, max_len=512):
         super(PositionalEncoding, self).__init__()
-        self.encoding = torch.zeros(max_len, d_model)
-        position = torch.arange(0, max_len).unsqueeze(1).float()
-        div_term = torch.exp(torch.arange(0, d_model, 2).float() * -(torch.log(torch.tensor(10000.0)) / d_model))
-        self.encoding[:, 0::2] = torch.sin(position * div_term)
-        self.encoding[:, 1::2] = torch.cos(position * div_term)
-        self.encoding = self.encoding.unsqueeze(0)
+        self.d_model = d_model
         self.device = device
+        # not persistent: rebuilt from d_model, so it stays out of checkpoints but follows .to(device)
+        self.register_buffer("encoding", self._build(max_len, device), persistent=False)
+
+    def _build(self, max_len, device):
+        encoding = torch.zeros(max_len, self.d_model, device=device)
+        position = torch.arange(0, max_len, device=device).unsqueeze(1).float()
+        div_term = torch.exp(torch.arange(0, self.d_model, 2, device=device).float() *
+                             -(torch.log(torch.tensor(10000.0)) / self.d_model))
+        encoding[:, 0::2] = torch.sin(position * div_term)
+        encoding[:, 1::2] = torch.cos(position * div_term)
+        return encoding.unsqueeze(0)
 
     def forward(self, x):
-        return x + self.encoding[:, :x.size(1)].to(self.device)
+        l = x.size(1)
+        if l > self.encoding.size(1):
+            # grow lazily and keep the longer table for the following calls
+            self.encoding = self._build(max(l, 2 * self.encoding.size(1)), self.encoding.device)
+
+        encoding = self.encoding[:, :l].to(x.dtype)
+        # x is the freshly computed embedding, so it can be updated in place unless it is a leaf needing grad
+        if x.requires_grad and x.is_leaf:
+            return x + encoding
+        return x.add_(encoding)
 
 
 class DecoderLayer(nn.Module):
 
-    def __init__(self, d_model, n_heads, attn_type, seed, device):
+    def __init__(self, d_model, n_heads, attn_type, seed, device, attn_backend="einsum", attn_version=1):
 
         super(DecoderLayer, self).__init__()
 
@@ -32,10 +51,12 @@ class DecoderLayer(nn.Module):
 
         self.dec_self_attn = MultiHeadAttention(
             d_model=d_model, n_heads=n_heads,
-            attn_type=attn_type, seed=seed, device=device)
+            attn_type=attn_type, seed=seed, device=device,
+            attn_backend=attn_backend, attn_version=attn_version)
         self.dec_enc_attn = MultiHeadAttention(
             d_model=d_model, n_heads=n_heads,
-            attn_type=attn_type, seed=seed, device=device)
+            attn_type=attn_type, seed=seed, device=device,
+            attn_backend=attn_backend, attn_version=attn_version)
 
         self.pos_ffn = nn.Sequential(nn.Linear(d_model, d_model*4),
                                      nn.ReLU(),
@@ -56,26 +77,92 @@ class DecoderLayer(nn.Module):
         return out3
 
 
+def _clone_layers(layer, num_layers, share_weights):
+    """
+    Stack of num_layers layers with independent weights (deep copies of layer),
+    or a single layer applied num_layers times when share_weights is set.
+    """
+    if share_weights:
+        return nn.ModuleList([layer])
+    return nn.ModuleList([copy.deepcopy(layer) for _ in range(num_layers)])
+
+
+def _drop_tied_layer_keys(layers_name):
+    """
+    Load-state-dict pre-hook for weight-tied stacks, checkpoints written when every layer
+    was stored under its own index only keep the weights of the first one.
+    """
+    def hook(state_dict, prefix, *args):
+        for key in list(state_dict.keys()):
+            if key.startswith(prefix + layers_name + ".") and \
+                    not key.startswith(prefix + layers_name + ".0."):
+                del state_dict[key]
+    return hook
+
+
+@contextmanager
+def _frozen_norm_stats(module):
+    """Restores the running statistics of every batch norm in module on exit."""
+    norms = [m for m in module.modules()
+             if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [[buffer.clone() for buffer in (m.running_mean, m.running_var, m.num_batches_tracked)]
+             for m in norms]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, (running_mean, running_var, num_batches_tracked) in zip(norms, saved):
+                m.running_mean.copy_(running_mean)
+                m.running_var.copy_(running_var)
+                m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def _checkpoint_layer(layer, *inputs):
+    """
+    Runs layer under activation checkpointing. The recomputation in backward runs with frozen
+    batch norm statistics (ATA, ACAT), so they advance once per step as without checkpointing.
+    """
+    n_calls = []
+
+    def run(*args):
+        if n_calls:
+            with _frozen_norm_stats(layer):
+                return layer(*args)
+        n_calls.append(1)
+        return layer(*args)
+
+    return checkpoint(run, *inputs, use_reentrant=False)
+
+
 class Decoder(nn.Module):
 
-    def __init__(self, decoder_layer, num_layers):
+    def __init__(self, decoder_layer, num_layers, share_weights=False, use_checkpoint=False):
         super(Decoder, self).__init__()
 
         self.num_layers = num_layers
+        self.share_weights = share_weights
+        self.use_checkpoint = use_checkpoint
+
+        self.decoder_layers = _clone_layers(decoder_layer, num_layers, share_weights)
 
-        self.decoder_layers = nn.ModuleList([decoder_layer for _ in range(num_layers)])
+        if share_weights:
+            self._register_load_state_dict_pre_hook(_drop_tied_layer_keys("decoder_layers"))
 
     def forward(self, dec_inputs, enc_outputs):
 
         for i in range(self.num_layers):
-            dec_inputs = self.decoder_layers[i](dec_inputs, enc_outputs)
+            layer = self.decoder_layers[0 if self.share_weights else i]
+            if self.use_checkpoint and self.training:
+                dec_inputs = _checkpoint_layer(layer, dec_inputs, enc_outputs)
+            else:
+                dec_inputs = layer(dec_inputs, enc_outputs)
 
         return dec_inputs
 
 
 class EncoderLayer(nn.Module):
 
-    def __init__(self, d_model, n_heads, attn_type, seed, device):
+    def __init__(self, d_model, n_heads, attn_type, seed, device, attn_backend="einsum", attn_version=1):
 
         super(EncoderLayer, self).__init__()
 
@@ -83,7 +170,8 @@ class EncoderLayer(nn.Module):
 
         self.enc_self_attn = MultiHeadAttention(
             d_model=d_model, n_heads=n_heads,
-            attn_type=attn_type, seed=seed, device=device)
+            attn_type=attn_type, seed=seed, device=device,
+            attn_backend=attn_backend, attn_version=attn_version)
 
         self.pos_ffn = nn.Sequential(nn.Linear(d_model, d_model*4),
                                      nn.ReLU(),
@@ -103,51 +191,86 @@ class EncoderLayer(nn.Module):
 
 class Encoder(nn.Module):
 
-    def __init__(self, encoder_layer, num_layers):
+    def __init__(self, encoder_layer, num_layers, share_weights=False, use_checkpoint=False):
         super(Encoder, self).__init__()
 
         self.num_layers = num_layers
+        self.share_weights = share_weights
+        self.use_checkpoint = use_checkpoint
 
-        self.encoder_layers = nn.ModuleList([encoder_layer for _ in range(num_layers)])
+        self.encoder_layers = _clone_layers(encoder_layer, num_layers, share_weights)
+
+        if share_weights:
+            self._register_load_state_dict_pre_hook(_drop_tied_layer_keys("encoder_layers"))
 
     def forward(self, enc_inputs):
 
         for i in range(self.num_layers):
-            enc_inputs = self.encoder_layers[i](enc_inputs)
+            layer = self.encoder_layers[0 if self.share_weights else i]
+            if self.use_checkpoint and self.training:
+                enc_inputs = _checkpoint_layer(layer, enc_inputs)
+            else:
+                enc_inputs = layer(enc_inputs)
 
         return enc_inputs
 
 
 class Transformer(nn.Module):
 
-    def __init__(self, input_size, d_model, nheads, num_layers, attn_type, seed, device="cpu"):
+    def __init__(self, input_size, d_model, nheads, num_layers, attn_type, seed, device="cpu",
+                 attn_backend="einsum", share_layers=False, use_checkpoint=False,
+                 enc_ratio=0.25, encoder_only=False, attn_version=1):
 
         super(Transformer, self).__init__()
 
         set_seed(seed)
+
+        # share of the window fed to the encoder, the rest goes through the decoder
+        self.enc_ratio = enc_ratio
+        self.encoder_only = encoder_only
+
         self.enc_embedding = nn.Linear(input_size, d_model)
-        self.dec_embedding = nn.Linear(input_size, d_model)
-        self.encoder_layer = EncoderLayer(d_model=d_model, attn_type=attn_type,
-                                          n_heads=nheads, seed=seed, device=device)
-        self.decoder_layer = DecoderLayer(d_model=d_model, attn_type=attn_type,
-                                          n_heads=nheads, seed=seed, device=device)
-
-        self.encoder = Encoder(self.encoder_layer, num_layers=num_layers)
-        self.decoder = Decoder(self.decoder_layer, num_layers=num_layers)
+        if not encoder_only:
+            self.dec_embedding = nn.Linear(input_size, d_model)
+        encoder_layer = EncoderLayer(d_model=d_model, attn_type=attn_type,
+                                     n_heads=nheads, seed=seed, device=device,
+                                     attn_backend=attn_backend, attn_version=attn_version)
+        self.encoder = Encoder(encoder_layer, num_layers=num_layers,
+                               share_weights=share_layers, use_checkpoint=use_checkpoint)
+
+        if not encoder_only:
+            decoder_layer = DecoderLayer(d_model=d_model, attn_type=attn_type,
+                                         n_heads=nheads, seed=seed, device=device,
+                                         attn_backend=attn_backend, attn_version=attn_version)
+            self.decoder = Decoder(decoder_layer, num_layers=num_layers,
+                                   share_weights=share_layers, use_checkpoint=use_checkpoint)
         self.n_heads = nheads
         self.d_model = d_model
         self.device = device
 
         self.pos_emb = PositionalEncoding(d_model=d_model, device=device)
 
+        self._register_load_state_dict_pre_hook(self._drop_legacy_layer_keys)
+
+    @staticmethod
+    def _drop_legacy_layer_keys(state_dict, prefix, *args):
+        # older checkpoints also stored the stacked layer as top-level encoder_layer/decoder_layer
+        for key in list(state_dict.keys()):
+            if key.startswith(prefix + "encoder_layer.") or key.startswith(prefix + "decoder_layer."):
+                del state_dict[key]
+
     def forward(self, inputs):
 
+        if self.encoder_only:
+            enc_input = self.pos_emb(self.enc_embedding(inputs))
+            return self.encoder(enc_input)
+
         s_len = inputs.shape[1]
-        x = torch.split(inputs, split_size_or_sections=[int(s_len/4), int(s_len/4)*3], dim=1)
+        enc_len = min(max(int(s_len * self.enc_ratio), 1), s_len - 1)
 
-        enc_input = x[0]
+        enc_input = inputs[:, :enc_len]
 
-        dec_input = x[1]
+        dec_input = inputs[:, enc_len:]
 
         enc_input = self.enc_embedding(enc_input)
         dec_input = self.dec_embedding(dec_input)
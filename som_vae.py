@@ -1,7 +1,7 @@
 import torch
 from torch import nn
 
-from util_scores import get_scores
+from util_scores import ClusteringScorer, get_scores
 
 
 class LinearEncoder(nn.Module):
@@ -73,6 +73,7 @@ class SOMVAE(nn.Module):
         self.d_som = [3, 3]
         self.d_latent = d_latent
         self.n_clusters = n_clusters
+        self.scorer = ClusteringScorer(n_clusters=n_clusters)
 
         self.encoder = LinearEncoder(input_size=d_channel, seq_len=d_input,
                                      hidden_size=d_enc_dec, enc_out_dim=d_latent)
@@ -84,9 +85,11 @@ class SOMVAE(nn.Module):
         self.embeddings = nn.Parameter(nn.init.trunc_normal_(torch.empty((self.d_som[0],
                                                                           self.d_som[1], d_latent)),
                                                              std=0.05, a=-0.1, b=0.1))
+        # [H*W, 4] flat ids of the up, down, right and left neighbors, H*W where the grid ends
+        self.register_buffer("neighbor_index", self._build_neighbor_index(), persistent=False)
         self.mse_loss = nn.MSELoss()
 
-    def forward(self, x, y=None):
+    def forward(self, x, y=None, scorer=None):
 
         # encoding
         b, s_l = x.shape[0], x.shape[1]
@@ -96,8 +99,8 @@ class SOMVAE(nn.Module):
 
         z_e = self.encoder(x)
         # embedding
-        z_q, z_dist, k = self._find_closest_embedding(z_e, batch_size=x.shape[0])
-        z_q_neighbors = self._find_neighbors(z_q, k, batch_size=x.shape[0])
+        z_q, z_dist, k = self._find_closest_embedding(z_e)
+        z_q_neighbors = self._find_neighbors(z_q, k)
 
         x_q = self.decoder_q(z_q)
         x_e = self.decoder_e(z_e)
@@ -106,7 +109,12 @@ class SOMVAE(nn.Module):
 
         if y is not None:
             y = y[:, 0, :].reshape(-1)
-            adj_rand_index, nmi, f1, p_score = get_scores(y, k, self.n_clusters, device=self.device)
+            if scorer is not None:
+                scorer.update(y, k)
+                adj_rand_index, nmi, f1, p_score = 0, 0, 0, 0
+            else:
+                adj_rand_index, nmi, f1, p_score = get_scores(y, k, self.n_clusters, device=self.device,
+                                                              scorer=self.scorer)
         else:
             adj_rand_index, nmi, f1, p_score = 0, 0, 0, 0
 
@@ -117,56 +125,36 @@ class SOMVAE(nn.Module):
         k_2 = k % self.d_som[1]
         return k_1, k_2
 
-    def _find_neighbors(self, z_q, k, batch_size):
+    def _build_neighbor_index(self):
+        k = torch.arange(self.d_som[0] * self.d_som[1])
         k_1, k_2 = self._get_coordinates_from_idx(k)
+        sentinel = len(k)
 
-        k1_not_top = k_1 < self.d_som[0] - 1
-        k1_not_bottom = k_1 > 0
-        k2_not_right = k_2 < self.d_som[1] - 1
-        k2_not_left = k_2 > 0
+        k_up = torch.where(k_1 < self.d_som[0] - 1, k + self.d_som[1], sentinel)
+        k_down = torch.where(k_1 > 0, k - self.d_som[1], sentinel)
+        k_right = torch.where(k_2 < self.d_som[1] - 1, k + 1, sentinel)
+        k_left = torch.where(k_2 > 0, k - 1, sentinel)
 
-        k1_up = torch.where(k1_not_top, k_1 + 1, k_1)
-        k1_down = torch.where(k1_not_bottom, k_1 - 1, k_1)
-        k2_right = torch.where(k2_not_right, k_2 + 1, k_2)
-        k2_left = torch.where(k2_not_left, k_2 - 1, k_2)
+        return torch.stack([k_up, k_down, k_right, k_left], dim=1)
 
-        z_q_up = torch.zeros(batch_size, self.d_latent).to(self.device)
-        z_q_up_ = self._gather_nd(self.embeddings, torch.stack([k1_up, k_2], dim=1))
-        z_q_up[k1_not_top == 1] = z_q_up_[k1_not_top == 1]
+    def _codebook(self):
+        """[H*W, d_latent] view of the SOM embeddings."""
+        return self.embeddings.reshape(-1, self.d_latent)
 
-        z_q_down = torch.zeros(batch_size, self.d_latent).to(self.device)
-        z_q_down_ = self._gather_nd(self.embeddings, torch.stack([k1_down, k_2], dim=1))
-        z_q_down[k1_not_bottom == 1] = z_q_down_[k1_not_bottom == 1]
+    def _find_neighbors(self, z_q, k):
+        # the sentinel row is zero, so neighbors outside the grid contribute zeros as before
+        codebook = torch.cat([self._codebook(), self._codebook().new_zeros(1, self.d_latent)], dim=0)
+        z_q_neighbors = codebook.index_select(0, self.neighbor_index[k].reshape(-1))
+        z_q_neighbors = z_q_neighbors.reshape(len(k), 4, self.d_latent)
 
-        z_q_right = torch.zeros(batch_size, self.d_latent).to(self.device)
-        z_q_right_ = self._gather_nd(self.embeddings, torch.stack([k_1, k2_right], dim=1))
-        z_q_right[k2_not_right == 1] = z_q_right_[k2_not_right == 1]
+        return torch.cat([z_q.unsqueeze(1), z_q_neighbors], dim=1)
 
-        z_q_left = torch.zeros(batch_size, self.d_latent).to(self.device)
-        z_q_left_ = self._gather_nd(self.embeddings, torch.stack([k_1, k2_left], dim=1))
-        z_q_left[k2_not_left == 1] = z_q_left_[k2_not_left == 1]
-
-        return torch.stack([z_q, z_q_up, z_q_down, z_q_right, z_q_left], dim=1)
-
-    @staticmethod
-    def _gather_nd(params, idx):
-        """Similar to tf.gather_nd. Here: returns batch of params given the indices."""
-        idx = idx.long()
-        outputs = []
-        for i in range(len(idx)):
-            outputs.append(params[[idx[i][j] for j in range(idx.shape[1])]])
-        outputs = torch.stack(outputs)
-        return outputs
-
-    def _find_closest_embedding(self, z_e, batch_size):
+    def _find_closest_embedding(self, z_e):
         """Picks the closest embedding for every encoding."""
-        z_dist = (z_e.unsqueeze(1).unsqueeze(2) - self.embeddings.unsqueeze(0)) ** 2
-        z_dist_sum = torch.sum(z_dist, dim=-1)
-        z_dist_flat = z_dist_sum.view(batch_size, -1)
+        codebook = self._codebook()
+        z_dist_flat = torch.sum((z_e.unsqueeze(1) - codebook.unsqueeze(0)) ** 2, dim=-1)
         k = torch.argmin(z_dist_flat, dim=-1)
-        k_1, k_2 = self._get_coordinates_from_idx(k)
-        k_batch = torch.stack([k_1, k_2], dim=1)
-        return self._gather_nd(self.embeddings, k_batch), z_dist_flat, k
+        return codebook.index_select(0, k), z_dist_flat, k
 
     def _loss_reconstruct(self, x, x_e, x_q):
         l_e = self.mse_loss(x, x_e)
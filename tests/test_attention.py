@@ -0,0 +1,61 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+multi_head_attn = pytest.importorskip("modules.multi_head_attn")
+
+BATCH_SIZE = 3
+N_HEADS = 2
+D_K = 4
+SEQ_LEN = 6
+
+
+def build(attn_type, backend, attn_version):
+    attention, _ = multi_head_attn.build_attention(attn_type, D_K, N_HEADS, seed=1234, device="cpu",
+                                                   backend=backend, attn_version=attn_version)
+    return attention
+
+
+def qkv(l_k=SEQ_LEN):
+    generator = torch.Generator().manual_seed(0)
+    return (torch.randn(BATCH_SIZE, N_HEADS, SEQ_LEN, D_K, generator=generator),
+            torch.randn(BATCH_SIZE, N_HEADS, l_k, D_K, generator=generator),
+            torch.randn(BATCH_SIZE, N_HEADS, l_k, D_K, generator=generator))
+
+
+@pytest.mark.parametrize("attn_type", ["basic", "conv_attn"])
+@pytest.mark.parametrize("mask", [False, True])
+def test_sdpa_matches_einsum_under_version_2(attn_type, mask):
+    Q, K, V = qkv()
+
+    context, attn = build(attn_type, "einsum", 2)(Q, K, V, mask=mask)
+    context_sdpa, _ = build(attn_type, "sdpa", 2)(Q, K, V, mask=mask)
+
+    torch.testing.assert_close(context_sdpa, context)
+    if attn_type == "basic":
+        torch.testing.assert_close(context, attn @ V)
+
+
+def test_version_1_reproduces_the_legacy_einsum():
+    Q, K, V = qkv(l_k=SEQ_LEN + 2)
+
+    context, attn = build("basic", "einsum", 1)(Q, K, V, mask=True)
+
+    torch.testing.assert_close(context, torch.einsum('bhqk,bhvd->bhqd', attn, V))
+    torch.testing.assert_close(context, V.sum(-2, keepdim=True).expand_as(context))
+
+
+def test_sdpa_refuses_version_1():
+    with pytest.raises(ValueError):
+        build("basic", "sdpa", 1)
+
+
+def test_state_dict_without_attn_version_loads_as_version_1():
+    state_dict = build("conv_attn", "einsum", 2).state_dict()
+    del state_dict["_attn_version"]
+
+    attention = build("conv_attn", "einsum", 2)
+    attention.load_state_dict(state_dict)
+    assert attention.attn_version == 1
+
+    with pytest.raises(ValueError):
+        build("conv_attn", "sdpa", 2).load_state_dict(state_dict)
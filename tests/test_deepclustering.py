@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+deepclustering = pytest.importorskip("deepclustering")
+
+BATCH_SIZE = 4
+SEQ_LEN = 8
+INPUT_SIZE = 2
+D_MODEL = 8
+
+
+def build_model(rec_version=2, **kwargs):
+    model = deepclustering.DeepClustering(input_size=INPUT_SIZE, knns=2, d_model=D_MODEL, nheads=2,
+                                          n_clusters=2, num_layers=1, attn_type="basic", seed=1234,
+                                          device="cpu", pred_len=4, batch_size=BATCH_SIZE,
+                                          rec_version=rec_version, **kwargs)
+    return model.eval()
+
+
+def run(model):
+    """Returns the encoder output and the reconstruction fed to proj_down."""
+    captured = {}
+    model.seq_model.register_forward_hook(lambda module, inputs, output: captured.update(x_enc=output))
+    model.proj_down.register_forward_hook(lambda module, inputs, output: captured.update(x_rec=inputs[0]))
+
+    x = torch.randn(BATCH_SIZE, SEQ_LEN, INPUT_SIZE, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        model(x)
+
+    x_enc_re = captured["x_enc"].reshape(BATCH_SIZE, -1)
+    return x_enc_re, captured["x_rec"].reshape(BATCH_SIZE, -1)
+
+
+def masked_scores(x_enc_re):
+    attn_score = x_enc_re @ x_enc_re.T / np.sqrt(D_MODEL * SEQ_LEN)
+    attn_score = attn_score.masked_fill(torch.eye(BATCH_SIZE, dtype=torch.bool), -torch.inf)
+    return torch.softmax(attn_score, dim=-1)
+
+
+def test_rec_version_2_reconstructs_from_the_other_windows():
+    x_enc_re, x_rec = run(build_model(rec_version=2))
+
+    torch.testing.assert_close(x_rec, masked_scores(x_enc_re) @ x_enc_re)
+
+
+def test_sdpa_reconstruction_matches_the_dense_path():
+    x_enc_re, x_rec = run(build_model(attn_backend="sdpa", attn_version=2))
+
+    torch.testing.assert_close(x_rec, masked_scores(x_enc_re) @ x_enc_re)
+
+
+def test_sdpa_model_matches_the_einsum_model_under_attn_version_2():
+    x_enc_re, x_rec = run(build_model(attn_version=2))
+    x_enc_re_sdpa, x_rec_sdpa = run(build_model(attn_backend="sdpa", attn_version=2))
+
+    torch.testing.assert_close(x_enc_re_sdpa, x_enc_re)
+    torch.testing.assert_close(x_rec_sdpa, x_rec)
+
+
+def test_blocked_reconstruction_matches_the_dense_path():
+    x_enc_re, x_rec = run(build_model(block_size=3))
+
+    torch.testing.assert_close(x_rec, masked_scores(x_enc_re) @ x_enc_re)
+
+
+def test_top_k_over_every_other_window_matches_the_dense_path():
+    model = build_model(use_knns=True)
+    model.k = BATCH_SIZE - 1
+    x_enc_re, x_rec = run(model)
+
+    torch.testing.assert_close(x_rec, masked_scores(x_enc_re) @ x_enc_re)
+
+
+def test_rec_version_1_reproduces_the_legacy_einsum():
+    x_enc_re, x_rec = run(build_model(rec_version=1))
+
+    torch.testing.assert_close(x_rec, torch.einsum('bd, bc-> bd', x_enc_re, masked_scores(x_enc_re)))
+
+
+def test_state_dict_without_rec_version_loads_as_version_1():
+    state_dict = build_model(rec_version=2).state_dict()
+    del state_dict["_rec_version"]
+
+    model = build_model(rec_version=2)
+    model.load_state_dict(state_dict)
+
+    assert model.rec_version == 1
+    assert model._rec_version.item() == 1
@@ -0,0 +1,56 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+MultiScaleConv = pytest.importorskip("forecasting_models.MultiScaleConv")
+
+KERNEL_SIZES = [1, 3, 7, 9]
+IN_CHANNELS = 4
+OUT_CHANNELS = 2
+
+
+def build_convs():
+    torch.manual_seed(0)
+    convs_q = [torch.nn.Conv1d(IN_CHANNELS, OUT_CHANNELS, f, padding=f // 2) for f in KERNEL_SIZES]
+    convs_k = [torch.nn.Conv1d(IN_CHANNELS, OUT_CHANNELS, f, padding=f // 2) for f in KERNEL_SIZES]
+    return convs_q, convs_k
+
+
+def effective_taps(conv):
+    # taps of every scale as a [n_convs, OUT_CHANNELS, IN_CHANNELS, max kernel] view of the masked weight
+    weight = (conv.weight * conv.tap_mask).detach()
+    return weight.reshape(-1, OUT_CHANNELS, IN_CHANNELS, weight.shape[-1])
+
+
+@pytest.mark.parametrize("l_k", [16, 12])
+def test_matches_the_per_scale_convs(l_k):
+    convs_q, convs_k = build_convs()
+    conv = MultiScaleConv.MultiScaleConv1d(convs_q, convs_k)
+
+    Q, K = torch.randn(3, IN_CHANNELS, 16), torch.randn(3, IN_CHANNELS, l_k)
+    out_q, out_k = conv(Q, K)
+
+    torch.testing.assert_close(out_q, torch.cat([c(Q) for c in convs_q], dim=1))
+    torch.testing.assert_close(out_k, torch.cat([c(K) for c in convs_k], dim=1))
+
+
+def test_padded_taps_stay_zero_after_an_optimizer_step():
+    conv = MultiScaleConv.MultiScaleConv1d(*build_convs())
+    optimizer = torch.optim.SGD(conv.parameters(), lr=1.0)
+
+    Q, K = torch.randn(3, IN_CHANNELS, 16), torch.randn(3, IN_CHANNELS, 16)
+    out_q, out_k = conv(Q, K)
+    (out_q.pow(2).sum() + out_k.pow(2).sum()).backward()
+    optimizer.step()
+
+    taps = effective_taps(conv)
+    m_f = max(KERNEL_SIZES)
+    for i, f in enumerate(KERNEL_SIZES * 2):
+        pad = (m_f - f) // 2
+        assert not taps[i, ..., :pad].any() and not taps[i, ..., m_f - pad:].any()
+        assert taps[i, ..., pad:m_f - pad].all()
+
+
+def test_state_dict_has_no_tap_mask():
+    conv = MultiScaleConv.MultiScaleConv1d(*build_convs())
+
+    assert "tap_mask" not in conv.state_dict()
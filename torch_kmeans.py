@@ -0,0 +1,108 @@
+import torch
+import torch.nn as nn
+
+
+class TorchKMeans(nn.Module):
+    """
+    Mini-batch friendly k-means that runs on the device of its inputs.
+    k-means++ initialization, batched Lloyd iterations and a tolerance-based early stop.
+    The centroids are kept in a buffer so they are saved with the model that owns this module
+    and, with warm_start, every fit starts from the centroids of the previous one.
+
+    :param n_clusters: number of clusters
+    :param max_iter: maximum number of Lloyd iterations per fit
+    :param tol: stop when the squared centroid shift falls below tol times the mean feature variance
+    :param warm_start: start from the stored centroids instead of a k-means++ initialization
+    :param seed: seed of the initialization
+    """
+    def __init__(self, n_clusters, max_iter=100, tol=1e-4, warm_start=True, seed=1234):
+
+        super(TorchKMeans, self).__init__()
+
+        self.n_clusters = n_clusters
+        self.max_iter = max_iter
+        self.tol = tol
+        self.warm_start = warm_start
+        self.seed = seed
+        self._generator = None
+
+        # [n_clusters, n_features] once fitted, the feature size is only known at the first fit
+        self.register_buffer("centroids", torch.empty(0))
+        self._register_load_state_dict_pre_hook(self._resize_centroids)
+
+    def _resize_centroids(self, state_dict, prefix, *args):
+        key = prefix + "centroids"
+        if key not in state_dict:
+            # checkpoints written before the model had a k-means state
+            state_dict[key] = self.centroids
+        elif state_dict[key].shape != self.centroids.shape:
+            self.centroids = torch.empty_like(state_dict[key], device=self.centroids.device)
+
+    @property
+    def is_fitted(self):
+        return self.centroids.dim() == 2
+
+    def _get_generator(self, device):
+        if self._generator is None or self._generator.device != device:
+            self._generator = torch.Generator(device=device).manual_seed(self.seed)
+        return self._generator
+
+    @staticmethod
+    def _sq_distances(x, centroids):
+        # [N, K] squared euclidean distances without materializing [N, K, D]
+        return (x.pow(2).sum(-1, keepdim=True) - 2 * x @ centroids.transpose(0, 1)
+                + centroids.pow(2).sum(-1).unsqueeze(0)).clamp_min_(0)
+
+    def _init_centroids(self, x):
+        """k-means++ initialization."""
+        generator = self._get_generator(x.device)
+        n = x.shape[0]
+
+        centroids = torch.empty(self.n_clusters, x.shape[1], dtype=x.dtype, device=x.device)
+        centroids[0:1] = x[torch.randint(n, (1,), generator=generator, device=x.device)]
+        min_dist = self._sq_distances(x, centroids[:1]).squeeze(-1)
+
+        for i in range(1, self.n_clusters):
+            # all points coincide with the chosen centroids, fall back to uniform sampling
+            probs = min_dist if min_dist.sum() > 0 else torch.ones_like(min_dist)
+            centroids[i:i + 1] = x[torch.multinomial(probs, 1, generator=generator)]
+            min_dist = torch.minimum(min_dist, self._sq_distances(x, centroids[i:i + 1]).squeeze(-1))
+
+        return centroids
+
+    @torch.no_grad()
+    def fit_predict(self, x):
+        """
+        :param x: [N, D] samples
+        :return: [N] cluster assignments
+        """
+        x = x.float()
+
+        if self.warm_start and self.is_fitted and self.centroids.shape[1] == x.shape[1]:
+            centroids = self.centroids.to(x.device)
+        else:
+            centroids = self._init_centroids(x)
+
+        tol = self.tol * x.var(dim=0).mean()
+        ones = torch.ones(x.shape[0], dtype=x.dtype, device=x.device)
+
+        for _ in range(self.max_iter):
+
+            labels = self._sq_distances(x, centroids).argmin(dim=-1)
+
+            sums = torch.zeros_like(centroids).index_add_(0, labels, x)
+            counts = torch.zeros(self.n_clusters, dtype=x.dtype, device=x.device).index_add_(0, labels, ones)
+            # empty clusters keep their previous centroid
+            new_centroids = torch.where(counts.unsqueeze(-1) > 0, sums / counts.clamp_min(1).unsqueeze(-1), centroids)
+
+            shift = (new_centroids - centroids).pow(2).sum()
+            centroids = new_centroids
+            if shift <= tol:
+                break
+
+        self.centroids = centroids
+        return self._sq_distances(x, centroids).argmin(dim=-1)
+
+    @torch.no_grad()
+    def predict(self, x):
+        return self._sq_distances(x.float(), self.centroids).argmin(dim=-1)
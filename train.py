@@ -3,6 +3,7 @@ import os
 from itertools import product
 import random
 import statistics
+import time
 import matplotlib.lines
 import matplotlib.pyplot as plt
 import optuna
@@ -15,11 +16,11 @@ import numpy as np
 from optuna.trial import TrialState
 
 from DTCR import DTCR
-from GMM import GmmDiagonal
+from GMM import GmmDiagonal, GmmFull
 from deepclustering import DeepClustering
 from mnist_data import MnistDataLoader
 from data_loader_userid import UserDataLoader
-from Kmeans import Kmeans
+from Kmeans import BASELINE_METRICS, Kmeans
 from matplotlib.patches import Circle
 from matplotlib.colors import to_rgba
 
@@ -27,6 +28,7 @@ from psycology_data_loader import PatientDataLoader
 from som_vae import SOMVAE
 from synthetic_data import SyntheticDataLoader
 from seed_manager import set_seed
+from util_scores import ClusteringScorer
 
 
 class Train:
@@ -40,13 +42,46 @@ class Train:
         parser.add_argument("--seed", type=int, default=1234)
         parser.add_argument("--cuda", type=str, default='cuda:0')
         parser.add_argument("--attn_type", type=str, default='basic')
+        parser.add_argument("--attn_backend", choices=['einsum', 'sdpa'], default='einsum',
+                            help='attention implementation (sdpa: torch scaled_dot_product_attention, '
+                                 'requires --attn_version 2)')
+        parser.add_argument("--attn_version", type=int, choices=[1, 2], default=1,
+                            help='1: legacy einsum contraction giving every query the sum of the values, '
+                                 '2: attention-weighted values attn @ V')
+        parser.add_argument("--share_layers", type=lambda x: str(x).lower() == "true", default=False,
+                            help='apply one weight-tied layer num_layers times')
+        parser.add_argument("--use_checkpoint", type=lambda x: str(x).lower() == "true", default=False,
+                            help='recompute the transformer layer activations in backward to save memory')
+        parser.add_argument("--enc_ratio", type=float, default=0.25,
+                            help='share of each window fed to the transformer encoder, the rest to the decoder')
+        parser.add_argument("--encoder_only", type=lambda x: str(x).lower() == "true", default=False,
+                            help='encode the whole window and skip the decoder and its cross-attention')
+        parser.add_argument("--precision", choices=['fp32', 'bf16'], default='fp32',
+                            help='bf16 runs forward passes under torch.autocast')
         parser.add_argument("--max_encoder_length", type=int, default=96)
         parser.add_argument("--pred_len", type=int, default=24)
         parser.add_argument("--max_train_sample", type=int, default=-1)
         parser.add_argument("--max_test_sample", type=int, default=-1)
         parser.add_argument("--batch_size", type=int, default=1024)
         parser.add_argument("--var", type=int, default=1)
-        parser.add_argument("--use_knns", type=lambda x: str(x).lower() == "true", default=False)
+        parser.add_argument("--use_knns", type=lambda x: str(x).lower() == "true", default=False,
+                            help='restrict the batch-similarity softmax to the knns most similar windows')
+        parser.add_argument("--kmeans_warm_start", type=lambda x: str(x).lower() == "true", default=True,
+                            help='start the k-means of every test batch from the previous batch centroids')
+        parser.add_argument("--block_size", type=int, default=-1,
+                            help='windows per block of the batch similarity, -1 for one dense matrix')
+        parser.add_argument("--use_em", type=lambda x: str(x).lower() == "true", default=False,
+                            help='fit the gmm mixture parameters with closed-form EM steps instead of Adam')
+        parser.add_argument("--per_sample_shuffle", type=lambda x: str(x).lower() == "true", default=False,
+                            help='draw the DTCR fake-sample shuffle independently for every window')
+        parser.add_argument("--pack_padded", type=lambda x: str(x).lower() == "true", default=False,
+                            help='pack zero-padded windows so the DTCR LSTMs skip their padding')
+        parser.add_argument("--kmeans_mode", choices=['per_batch', 'streaming'], default='per_batch',
+                            help='kmeans baseline: one KMeans per batch or one MiniBatchKMeans over the split')
+        parser.add_argument("--n_workers", type=int, default=1,
+                            help='parallel workers of the kmeans, dtw_kmeans and kshape baselines')
+        parser.add_argument("--dtw_radius", type=int, default=-1,
+                            help='Sakoe-Chiba radius of dtw_kmeans, -1 for 10%% of the window')
         parser.add_argument("--data_path", type=str, default='watershed.csv')
         parser.add_argument('--cluster', choices=['yes', 'no'], default='no',
                             help='Enable or disable a feature (choices: yes, no)')
@@ -57,6 +92,11 @@ class Train:
         self.exp_name = args.exp_name
         self.var = args.var
         self.use_knns = args.use_knns
+        self.kmeans_warm_start = args.kmeans_warm_start
+        self.use_em = args.use_em
+        self.per_sample_shuffle = args.per_sample_shuffle
+        self.pack_padded = args.pack_padded
+        self.block_size = args.block_size if args.block_size > 0 else None
 
         if self.exp_name == "mnist":
             pass
@@ -76,6 +116,13 @@ class Train:
         print("using {}".format(self.device))
         self.exp_name = args.exp_name
         self.attn_type = args.attn_type
+        self.attn_backend = args.attn_backend
+        self.attn_version = args.attn_version
+        self.share_layers = args.share_layers
+        self.use_checkpoint = args.use_checkpoint
+        self.enc_ratio = args.enc_ratio
+        self.encoder_only = args.encoder_only
+        self.precision = args.precision
         self.num_iteration = args.max_train_sample
         self.max_encoder_length = args.max_encoder_length
 
@@ -121,15 +168,24 @@ class Train:
         self.batch_size = args.batch_size
         self.best_overall_valid_loss = 1e10
         self.list_explored_params = []
-        if args.model_name == "kmeans":
+        if args.model_name in BASELINE_METRICS:
             Kmeans(n_clusters=self.n_clusters, batch_size=self.batch_size,
                    data_loader=self.data_loader.test_loader, seed=self.seed,
-                   exp_name=self.exp_name)
+                   exp_name=self.exp_name, mode=args.kmeans_mode,
+                   n_workers=args.n_workers, metric=BASELINE_METRICS[args.model_name],
+                   radius=args.dtw_radius if args.dtw_radius > 0 else None)
         else:
             self.best_clustering_model = nn.Module()
             self.run_optuna(args)
             self.evaluate()
 
+    def autocast(self):
+        """
+        Mixed-precision context for forward passes, a no-op unless --precision bf16.
+        """
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16,
+                              enabled=self.precision == "bf16")
+
     def run_optuna(self, args):
 
         study = optuna.create_study(study_name=args.model_name,
@@ -174,11 +230,17 @@ class Train:
                            n_clusters=self.n_clusters,
                            d_latent=d_model,
                            device=self.device).to(self.device)
+        elif "gmm_full" in self.model_name:
+            model = GmmFull(num_feat=self.data_loader.input_size,
+                            num_components=self.n_clusters,
+                            num_dims=d_model,
+                            device=self.device).to(self.device)
         elif "gmm" in self.model_name:
             model = GmmDiagonal(num_feat=self.data_loader.input_size,
                                 num_components=self.n_clusters,
                                 num_dims=d_model,
-                                device=self.device).to(self.device)
+                                device=self.device,
+                                use_em=self.use_em).to(self.device)
         elif "DTCR" in self.model_name:
 
             model = DTCR(input_size=self.data_loader.input_size,
@@ -187,7 +249,9 @@ class Train:
                          num_layers=num_layers,
                          seed=self.seed,
                          device=self.device,
-                         batch_size=self.batch_size).to(self.device)
+                         batch_size=self.batch_size,
+                         per_sample_shuffle=self.per_sample_shuffle,
+                         pack_padded=self.pack_padded).to(self.device)
 
         else:
             model = DeepClustering(input_size=self.data_loader.input_size,
@@ -203,7 +267,15 @@ class Train:
                                    batch_size=self.batch_size,
                                    var=self.var,
                                    gamma=gamma,
-                                   use_knns=self.use_knns).to(self.device)
+                                   use_knns=self.use_knns,
+                                   attn_backend=self.attn_backend,
+                                   attn_version=self.attn_version,
+                                   share_layers=self.share_layers,
+                                   use_checkpoint=self.use_checkpoint,
+                                   enc_ratio=self.enc_ratio,
+                                   encoder_only=self.encoder_only,
+                                   block_size=self.block_size,
+                                   kmeans_warm_start=self.kmeans_warm_start).to(self.device)
 
         cluster_optimizer = Adam(model.parameters())
         scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(cluster_optimizer, T_max=tmax)
@@ -217,10 +289,14 @@ class Train:
 
             model.train()
             train_knn_loss = 0
+            n_train_samples = 0
+            epoch_start = time.perf_counter()
 
             for x, y in self.data_loader.train_loader:
 
-                loss, adj_rand_index, nmi, acc, p_score, _ = model(x.to(self.device))
+                with self.autocast():
+                    loss, adj_rand_index, nmi, acc, p_score, _ = model(x.to(self.device))
+                n_train_samples += len(x)
 
                 cluster_optimizer.zero_grad()
                 loss.backward()
@@ -235,6 +311,8 @@ class Train:
             #     train_p_loss += p_score.item()
             #
             list_of_train_loss.append(train_knn_loss/self.data_loader.len_train)
+            print("train throughput ({}): {:.1f} samples/s, epoch: {}"
+                  .format(self.precision, n_train_samples / (time.perf_counter() - epoch_start), epoch))
             # list_of_train_adj.append(train_adj_loss/self.data_loader.len_train)
             # list_of_train_nmi.append(train_nmi_loss/self.data_loader.len_train)
             # list_of_train_acc.append(train_acc_loss/self.data_loader.len_train)
@@ -245,7 +323,8 @@ class Train:
 
             for x, y in self.data_loader.test_loader:
 
-                loss, adj_rand_index, nmi, acc, p_score, _ = model(x.to(self.device))
+                with self.autocast():
+                    loss, adj_rand_index, nmi, acc, p_score, _ = model(x.to(self.device))
                 valid_knn_loss += loss.item()
                 # valid_adj_loss += adj_rand_index.item()
                 # valid_nmi_loss += nmi.item()
@@ -296,10 +375,8 @@ class Train:
 
         x_reconstructs = []
         knns = []
-        tot_adj_loss = []
-        tot_acc_loss = []
-        tot_nmi_loss = []
-        tot_p_loss = []
+        # one contingency table over every evaluated batch
+        scorer = ClusteringScorer(n_clusters=self.n_clusters)
 
         d_model_list = [16, 32]
         num_layers_list = [1, 3]
@@ -320,12 +397,20 @@ class Train:
                                                d_latent=d_model,
                                                device=self.device).to(self.device)
 
+                            elif "gmm_full" in self.model_name:
+
+                                model = GmmFull(num_feat=self.data_loader.input_size,
+                                                num_dims=d_model,
+                                                num_components=self.n_clusters,
+                                                device=self.device).to(self.device)
+
                             elif "gmm" in self.model_name:
 
                                 model = GmmDiagonal(num_feat=self.data_loader.input_size,
                                                     num_dims=d_model,
                                                     num_components=self.n_clusters,
-                                                    device=self.device).to(self.device)
+                                                    device=self.device,
+                                                    use_em=self.use_em).to(self.device)
 
                             elif "DTCR" in self.model_name:
 
@@ -335,7 +420,9 @@ class Train:
                                              num_layers=num_layers,
                                              seed=self.seed,
                                              device=self.device,
-                                             batch_size=self.batch_size).to(self.device)
+                                             batch_size=self.batch_size,
+                                             per_sample_shuffle=self.per_sample_shuffle,
+                                             pack_padded=self.pack_padded).to(self.device)
                             else:
                                 model = DeepClustering(input_size=self.data_loader.input_size,
                                                        n_clusters=self.n_clusters,
@@ -350,7 +437,15 @@ class Train:
                                                        var=self.var,
                                                        knns=knn,
                                                        gamma=gm,
-                                                       use_knns=self.use_knns).to(self.device)
+                                                       use_knns=self.use_knns,
+                                                       attn_backend=self.attn_backend,
+                                                       attn_version=self.attn_version,
+                                                       share_layers=self.share_layers,
+                                                       use_checkpoint=self.use_checkpoint,
+                                                       enc_ratio=self.enc_ratio,
+                                                       encoder_only=self.encoder_only,
+                                                       block_size=self.block_size,
+                                                       kmeans_warm_start=self.kmeans_warm_start).to(self.device)
 
                             checkpoint = torch.load(os.path.join(self.model_path, "{}_forecast.pth".format(self.model_name)),
                                                     map_location=self.device)
@@ -363,21 +458,16 @@ class Train:
 
                             for x, labels in self.data_loader.test_loader:
 
-                                _, adj_loss, nmi, acc, p_score, outputs = model(x.to(self.device), labels.to(self.device))
-                                tot_adj_loss.append(adj_loss.item())
-                                tot_nmi_loss.append(nmi.item())
-                                tot_acc_loss.append(acc.item())
-                                tot_p_loss.append(p_score.item())
+                                with self.autocast():
+                                    model(x.to(self.device), labels.to(self.device), scorer=scorer)
 
                         except RuntimeError:
                             pass
 
-        adj = statistics.mean(tot_adj_loss)
-        nmi = statistics.mean(tot_nmi_loss)
-        f1 = statistics.mean(tot_acc_loss)
-        p_score = statistics.mean(tot_p_loss)
+        adj, nmi, f1, p_score = [score.item() for score in scorer.compute()]
+        acc = scorer.accuracy().item()
 
-        print("adj rand index {:.3f}, nmi {:.3f}, f1 {:.3f}, p_score {:.3f}".format(adj, nmi, f1, p_score))
+        print("adj rand index {:.3f}, nmi {:.3f}, f1 {:.3f}, p_score {:.3f}, acc {:.3f}".format(adj, nmi, f1, p_score, acc))
 
         # Specify the file path
         file_path = "final_{}_{}.csv".format(self.exp_name, self.seed)
@@ -385,7 +475,8 @@ class Train:
         scores = {self.model_name: {'adj': f"{adj:.3f}",
                                     'f1': f"{f1: .3f}",
                                     'nmi': f"{nmi: .3f}",
-                                    'p_score': f"{p_score: .3f}"}}
+                                    'p_score': f"{p_score: .3f}",
+                                    'acc': f"{acc: .3f}"}}
 
         df = pd.DataFrame.from_dict(scores, orient='index')
 
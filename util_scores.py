@@ -1,25 +1,238 @@
-import numpy as np
 import torch
-from sklearn import metrics
-from torchmetrics import F1Score
-from torchmetrics.clustering import AdjustedRandScore, NormalizedMutualInfoScore
+from scipy.optimize import linear_sum_assignment
 
 
 def purity_score(y_true, y_pred):
-    # compute contingency matrix (also called confusion matrix)
-    contingency_matrix = metrics.cluster.contingency_matrix(y_true, y_pred)
-    # return purity
-    return np.sum(np.amax(contingency_matrix, axis=0)) / np.sum(contingency_matrix)
+    """Purity of cluster assignments, from the same contingency table as the other scores."""
+    scorer = ClusteringScorer(n_clusters=0)
+    scorer.update(torch.as_tensor(y_true), torch.as_tensor(y_pred))
+    contingency = scorer.contingency
+    return (contingency.max(dim=0).values.sum() / contingency.sum()).item()
 
 
-def get_scores(y, assigned_labels, n_clusters, device):
+def get_scores(y, assigned_labels, n_clusters, device, scorer=None):
+    """
+    Scores of a single batch. Pass the caller's ClusteringScorer to reuse its table across calls.
 
-    adj_rand_index = AdjustedRandScore()(assigned_labels.to(torch.long), y.to(torch.long))
-    nmi = NormalizedMutualInfoScore()(assigned_labels.to(torch.long), y.to(torch.long))
-    f1 = F1Score(task='multiclass', num_classes=n_clusters).to(device)(assigned_labels.to(torch.long),
-                                                                                 y.to(torch.long))
-    p_score = purity_score(y.to(torch.long).detach().cpu().numpy(),
-                           assigned_labels.to(torch.long).detach().cpu().numpy())
+    :return: adjusted rand index, nmi, f1, purity as 0-dim tensors on the device of y
+    """
+    scorer = ClusteringScorer(n_clusters=n_clusters) if scorer is None else scorer
+    scorer.reset()
+    scorer.update(y, assigned_labels)
+    return scorer.compute()
+
+
+def _comb2(n):
+    return n * (n - 1) / 2
+
+
+def aligned_accuracy_f1(contingency):
+    """
+    Accuracy and macro F1 after matching clusters to classes with the Hungarian algorithm,
+    so the scores do not depend on which id a cluster happens to get.
+    Classes left without a cluster (more classes than clusters) count with an F1 of 0.
+
+    :param contingency: [n_classes, n_clusters] table
+    :return: accuracy, macro F1 as 0-dim tensors
+    """
+    c = contingency.to(torch.float64)
+    n = c.sum()
+    a = c.sum(dim=1)
+    b = c.sum(dim=0)
+
+    # ids that never occur would only add zero-weight candidates to the matching
+    classes = torch.nonzero(a > 0).squeeze(-1)
+    clusters = torch.nonzero(b > 0).squeeze(-1)
+    c_seen = c[classes][:, clusters]
+
+    # the table is n_classes x n_clusters, solving it on the host is negligible
+    rows, cols = linear_sum_assignment(c_seen.cpu().numpy(), maximize=True)
+    rows = torch.as_tensor(rows, device=c.device)
+    cols = torch.as_tensor(cols, device=c.device)
+
+    matched = c_seen[rows, cols]
+    accuracy = matched.sum() / n
+
+    f1_per_class = torch.zeros(len(classes), dtype=c.dtype, device=c.device)
+    f1_per_class[rows] = 2 * matched / (a[classes[rows]] + b[clusters[cols]])
+    f1 = f1_per_class.mean()
+
+    return accuracy, f1
+
+
+def scores_from_contingency(contingency):
+    """
+    Adjusted rand index, normalized mutual information (arithmetic normalization), F1 and purity
+    of a [n_classes, n_clusters] contingency table, without revisiting the labels.
+
+    F1 is the macro F1 of the Hungarian matching between clusters and classes, see aligned_accuracy_f1.
+    """
+    c = contingency.to(torch.float64)
+    n = c.sum()
+    a = c.sum(dim=1)
+    b = c.sum(dim=0)
+
+    sum_comb = _comb2(c).sum()
+    sum_comb_a = _comb2(a).sum()
+    sum_comb_b = _comb2(b).sum()
+    expected_index = sum_comb_a * sum_comb_b / _comb2(n)
+    max_index = (sum_comb_a + sum_comb_b) / 2
+    adj_rand_index = torch.where(max_index == expected_index, torch.ones_like(n),
+                                 (sum_comb - expected_index) / (max_index - expected_index))
+
+    nz = c > 0
+    outer = a.unsqueeze(1) * b.unsqueeze(0)
+    mi = (c[nz] / n * (torch.log(c[nz]) + torch.log(n) - torch.log(outer[nz]))).sum()
+    h_a = -(a[a > 0] / n * torch.log(a[a > 0] / n)).sum()
+    h_b = -(b[b > 0] / n * torch.log(b[b > 0] / n)).sum()
+    normalizer = (h_a + h_b) / 2
+    nmi = torch.where(normalizer > 0, mi / normalizer.clamp_min(1e-12), torch.ones_like(n))
+
+    _, f1 = aligned_accuracy_f1(c)
+    p_score = c.max(dim=0).values.sum() / n
 
     return adj_rand_index, nmi, f1, p_score
 
+
+class LabelAligner:
+    """
+    Aligns the cluster ids of batches clustered by independent fits: the ids of every batch are matched
+    to running centroids of the previous batches (Hungarian matching on centroid distances).
+    The first batch defines the reference ids.
+
+    :param n_clusters: number of clusters of every fit
+    """
+    def __init__(self, n_clusters):
+
+        self.n_clusters = n_clusters
+        # per-cluster feature sums and counts of the aligned batches seen so far
+        self._centroid_sums = None
+        self._centroid_counts = None
+
+    def reset(self):
+        self._centroid_sums = None
+        self._centroid_counts = None
+
+    def align(self, assigned_labels, features):
+        """
+        :param assigned_labels: [n] cluster ids of one batch
+        :param features: [n, ...] samples the assignments were fitted on
+        :return: [n] cluster ids in the reference ids
+        """
+        assigned_labels = assigned_labels.reshape(-1).to(torch.long)
+        features = features.reshape(len(assigned_labels), -1).to(device=assigned_labels.device,
+                                                                  dtype=torch.float64)
+        n_ids = max(self.n_clusters, int(assigned_labels.max()) + 1)
+
+        sums = torch.zeros(n_ids, features.shape[1], dtype=features.dtype,
+                           device=features.device).index_add_(0, assigned_labels, features)
+        counts = torch.bincount(assigned_labels, minlength=n_ids)
+
+        if self._centroid_sums is None or self._centroid_sums.shape[1] != features.shape[1]:
+            self._centroid_sums = torch.zeros_like(sums)
+            self._centroid_counts = torch.zeros_like(counts)
+        else:
+            if n_ids > len(self._centroid_counts):
+                n_new = n_ids - len(self._centroid_counts)
+                self._centroid_sums = torch.cat([self._centroid_sums, sums.new_zeros(n_new, sums.shape[1])])
+                self._centroid_counts = torch.cat([self._centroid_counts, counts.new_zeros(n_new)])
+            n_ids = len(self._centroid_counts)
+            sums = torch.cat([sums, sums.new_zeros(n_ids - len(sums), sums.shape[1])])
+            counts = torch.cat([counts, counts.new_zeros(n_ids - len(counts))])
+
+            cost = torch.cdist(sums / counts.clamp_min(1).unsqueeze(-1),
+                               self._centroid_sums / self._centroid_counts.clamp_min(1).unsqueeze(-1))
+            # reference ids without centroid yet are matched last, empty batch clusters do not compete
+            cost[:, self._centroid_counts == 0] = cost.max() + 1
+            cost[counts == 0] = 0
+
+            rows, cols = linear_sum_assignment(cost.cpu().numpy())
+            mapping = torch.empty(n_ids, dtype=torch.long)
+            mapping[torch.as_tensor(rows)] = torch.as_tensor(cols)
+            mapping = mapping.to(assigned_labels.device)
+
+            assigned_labels = mapping[assigned_labels]
+            sums = torch.zeros_like(sums).index_copy_(0, mapping, sums)
+            counts = torch.zeros_like(counts).index_copy_(0, mapping, counts)
+
+        self._centroid_sums += sums
+        self._centroid_counts += counts
+        return assigned_labels
+
+
+class ClusteringScorer:
+    """
+    Streams true labels and cluster assignments into a single contingency table with torch.bincount,
+    so clustering metrics are computed once over the whole dataset instead of averaged over batches.
+    update only queues the ids of a batch on its device, without a host sync; they are counted when the
+    table is read, which sizes it once for every queued batch and grows it when larger ids show up.
+
+    Batches clustered by independent fits do not share cluster ids. Passing their features to update
+    aligns the ids of every batch with a LabelAligner before they are counted.
+    """
+    def __init__(self, n_clusters):
+
+        self.n_clusters = n_clusters
+        self._contingency = None
+        # [2, n] true labels and cluster ids of the batches not counted yet
+        self._pending = []
+        self._aligner = LabelAligner(n_clusters)
+
+    def reset(self):
+        # keep the allocated table, it is reused by the next updates
+        if self._contingency is not None:
+            self._contingency.zero_()
+        self._pending = []
+        self._aligner.reset()
+
+    @property
+    def contingency(self):
+        """[n_classes, n_clusters] table of every batch passed to update."""
+        if self._pending:
+            self._count(torch.cat(self._pending, dim=1))
+            self._pending = []
+        return self._contingency
+
+    def _count(self, pairs):
+
+        y, assigned_labels = pairs
+        if self._contingency is None:
+            self._contingency = torch.zeros(0, self.n_clusters, dtype=torch.long, device=y.device)
+
+        # a single host sync for both ids of every queued batch
+        max_y, max_label = pairs.amax(dim=1).tolist()
+        n_rows = max(self._contingency.shape[0], max_y + 1)
+        n_cols = max(self._contingency.shape[1], max_label + 1)
+        if (n_rows, n_cols) != tuple(self._contingency.shape):
+            contingency = torch.zeros(n_rows, n_cols, dtype=torch.long, device=y.device)
+            contingency[:self._contingency.shape[0], :self._contingency.shape[1]] = self._contingency
+            self._contingency = contingency
+
+        self._contingency += torch.bincount(y * n_cols + assigned_labels,
+                                            minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+
+    def update(self, y, assigned_labels, features=None):
+        """
+        :param features: [n, ...] samples the assignments were fitted on, pass them when every batch
+            is clustered by an independent fit so its cluster ids are aligned before counting
+            (the alignment itself matches the ids on the host)
+        """
+        y = y.reshape(-1).to(torch.long)
+        assigned_labels = assigned_labels.reshape(-1).to(torch.long).to(y.device)
+
+        if features is not None:
+            assigned_labels = self._aligner.align(assigned_labels, features)
+
+        self._pending.append(torch.stack([y, assigned_labels]))
+
+    def compute(self):
+        """
+        :return: adjusted rand index, nmi, f1, purity as 0-dim tensors
+        """
+        return scores_from_contingency(self.contingency)
+
+    def accuracy(self):
+        """
+        :return: Hungarian-aligned accuracy as a 0-dim tensor
+        """
+        return aligned_accuracy_f1(self.contingency)[0]